@@ -0,0 +1,83 @@
+"""Память на одного участника: прежний реестр из словарей против колоночного ParticipantRegistry.
+
+Оба реестра измеряются в одинаковом состоянии: индекс по username ещё не построен.
+Отдельно показан колоночный реестр с построенными индексами, как во время подведения итогов.
+
+Запуск: python bench_memory.py [участников]
+"""
+import os
+import random
+import sys
+import tracemalloc
+from typing import Dict, List
+
+os.environ.setdefault('BOT_TOKEN', '1:bench')
+
+from main import ParticipantRegistry  # noqa: E402
+
+
+class DictParticipantRegistry:
+    """Реестр до перехода на колонки: словарь на участника и индекс позиций по user_id.
+
+    Индекс по username, как и в колоночном реестре, не строится при добавлении.
+    """
+
+    def __init__(self):
+        self._items: List[Dict] = []
+        self._by_id: Dict[int, int] = {}
+
+    def add(self, user_id, username, name) -> bool:
+        if user_id in self._by_id:
+            return False
+        self._by_id[user_id] = len(self._items)
+        self._items.append({'user_id': user_id, 'username': username, 'name': name})
+        return True
+
+
+SYLLABLES = ["ал", "ек", "са", "ндр", "ма", "ри", "я", "дми", "три", "ан", "на", "ив", "ол", "ьга", "ka", "te", "jo", "hn"]
+
+
+def make_name(rng: random.Random) -> str:
+    """Имя и фамилия из случайных слогов: почти все имена разные, интернирование их не схлопывает"""
+    def word() -> str:
+        return "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))).capitalize()
+    return f"{word()} {word()}" if rng.random() < 0.7 else word()
+
+
+def make_rows(count: int):
+    rng = random.Random(42)
+    for i in range(count):
+        user_id = 5_000_000_000 + rng.randrange(1_000_000_000)
+        # Примерно у половины пользователей есть username
+        username = f"user_{user_id % 10_000_000}" if rng.random() < 0.5 else None
+        yield user_id + i, username, make_name(rng)
+
+
+def measure(factory, count: int, build_indexes: bool = False) -> float:
+    """Прирост памяти на участника, включая строки, которые реестр удерживает"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    registry = factory()
+    for row in make_rows(count):
+        registry.add(*row)
+    if build_indexes:
+        registry.index_of(registry[0]['user_id'])
+        registry.get_by_username('')
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return used / count
+
+
+def main() -> None:
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    old = measure(DictParticipantRegistry, count)
+    new = measure(ParticipantRegistry, count)
+    indexed = measure(ParticipantRegistry, count, build_indexes=True)
+    print(f"Участников: {count}")
+    print(f"Словари:             {old:7.1f} байт на участника")
+    print(f"Колонки:             {new:7.1f} байт на участника ({old / new:.1f}x меньше)")
+    print(f"Колонки с индексами: {indexed:7.1f} байт на участника")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,373 @@
+"""Нагрузочный тест main.py без Telegram.
+
+Бот ходит в локальную заглушку Bot API (TELEGRAM_API_URL) с настраиваемой задержкой,
+долей ошибок и ответов 429 (RetryAfter), а синтетические апдейты идут через настоящий
+диспетчер. Для каждого сценария выводится пропускная способность, p50/p99 задержки
+ответа и число запросов к API на апдейт.
+
+Сценарии:
+  join_storm    - тысячи нажатий "Участвовать" в одном конкурсе одновременно
+  inline_flood  - набор inline-запросов по буквам: 'conc ...' и ID конкурсов
+  start_menus   - /start и меню выбора конкурса у создателей с большим числом конкурсов
+
+Запуск: python loadtest.py [--scenario join_storm ...] [--latency 0.05] [--error-rate 0.01] ...
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import socket
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from aiogram import types
+from aiohttp import web
+
+SCENARIOS = ('join_storm', 'inline_flood', 'start_menus')
+CHANNEL = 'loadtest_channel'
+FAST_QUERY = f"conc Нагрузочный розыгрыш 3 5 @{CHANNEL}"
+
+
+class FakeBotAPI:
+    """Заглушка Bot API: правдоподобные ответы на методы, которые вызывает бот.
+
+    Ответы на callback и inline запросы отмечаются по их id, чтобы измерять задержку
+    до ответа пользователю, а не только до возврата из обработчика.
+    """
+
+    def __init__(self, latency: float, jitter: float, error_rate: float,
+                 retry_after_rate: float, retry_after: int, seed: int):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.retry_after_rate = retry_after_rate
+        self.retry_after = retry_after
+        self.calls: Counter = Counter()
+        self.errors: Counter = Counter()
+        self._rng = random.Random(seed)
+        self._message_ids = itertools.count(1)
+        self._waiters: Dict[str, asyncio.Future] = {}
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        return app
+
+    def expect_answer(self, query_id: str) -> asyncio.Future:
+        """Future, который получит время ответа на callback или inline запрос"""
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[query_id] = future
+        return future
+
+    @staticmethod
+    def _chat_id(value: str) -> int:
+        try:
+            return int(value)
+        except ValueError:
+            # @username канала -> стабильный отрицательный id
+            return -1_000_000_000_000 - sum(ord(c) * 31 ** i for i, c in enumerate(value.lstrip('@'))) % 10 ** 9
+
+    def _result(self, method: str, params: Dict[str, str]):
+        if method == 'getme':
+            return {'id': 1, 'is_bot': True, 'first_name': 'loadtest', 'username': 'loadtest_bot'}
+        if method == 'getchat':
+            username = params['chat_id'].lstrip('@') if params['chat_id'].startswith('@') else None
+            return {
+                'id': self._chat_id(params['chat_id']), 'type': 'channel',
+                'title': username or params['chat_id'], 'username': username or f"ch{params['chat_id'].lstrip('-')}"
+            }
+        if method == 'getchatmember':
+            user_id = int(params['user_id'])
+            return {'status': 'member', 'user': {'id': user_id, 'is_bot': False, 'first_name': f"u{user_id}"}}
+        if method in ('sendmessage', 'editmessagetext', 'senddocument'):
+            chat_id = self._chat_id(params.get('chat_id', '0'))
+            return {
+                'message_id': next(self._message_ids),
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'channel'},
+                'text': params.get('text', ''),
+            }
+        return True
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method'].lower()
+        params = {key: value for key, value in (await request.post()).items() if isinstance(value, str)}
+        self.calls[method] += 1
+        await asyncio.sleep(self.latency + self._rng.random() * self.jitter)
+
+        roll = self._rng.random()
+        if roll < self.retry_after_rate:
+            self.errors['retry_after'] += 1
+            return web.json_response({
+                'ok': False, 'error_code': 429,
+                'description': f"Too Many Requests: retry after {self.retry_after}",
+                'parameters': {'retry_after': self.retry_after},
+            }, status=429)
+        if roll < self.retry_after_rate + self.error_rate:
+            self.errors['server_error'] += 1
+            return web.json_response({'ok': False, 'error_code': 500, 'description': 'Internal Server Error'}, status=500)
+
+        query_id = params.get('callback_query_id') or params.get('inline_query_id')
+        if query_id:
+            future = self._waiters.pop(query_id, None)
+            if future and not future.done():
+                future.set_result(time.perf_counter())
+        return web.json_response({'ok': True, 'result': self._result(method, params)})
+
+
+class Step:
+    """Один апдейт сессии пользователя.
+
+    answer_id - ждать ответа API на этот callback/inline запрос; timed=False - апдейт
+    нагружает бота, но ответа на него не будет (промежуточная буква 'conc').
+    """
+
+    __slots__ = ('update', 'answer_id', 'timed', 'delay')
+
+    def __init__(self, update, answer_id: Optional[str] = None, timed: bool = True, delay: float = 0.0):
+        self.update = update
+        self.answer_id = answer_id
+        self.timed = timed
+        self.delay = delay
+
+
+class UpdateFactory:
+    def __init__(self):
+        self._update_ids = itertools.count(1)
+        self._query_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    @staticmethod
+    def user(user_id: int):
+        return types.User(id=user_id, is_bot=False, first_name=f"Участник {user_id}", username=f"user{user_id}")
+
+    def message(self, user_id: int, text: str) -> Step:
+        message = types.Message(
+            message_id=next(self._message_ids), date=datetime.now(),
+            chat=types.Chat(id=user_id, type='private'), from_user=self.user(user_id), text=text
+        )
+        return Step(types.Update(update_id=next(self._update_ids), message=message))
+
+    def callback(self, user_id: int, data: str, wait_answer: bool = False) -> Step:
+        query_id = f"cb{next(self._query_ids)}"
+        message = types.Message(
+            message_id=next(self._message_ids), date=datetime.now(),
+            chat=types.Chat(id=user_id, type='private'), text='menu'
+        )
+        call = types.CallbackQuery(
+            id=query_id, from_user=self.user(user_id), chat_instance='loadtest', data=data, message=message
+        )
+        return Step(types.Update(update_id=next(self._update_ids), callback_query=call),
+                    answer_id=query_id if wait_answer else None)
+
+    def inline(self, user_id: int, query: str, wait_answer: bool, delay: float) -> Step:
+        query_id = f"iq{next(self._query_ids)}"
+        inline_query = types.InlineQuery(id=query_id, from_user=self.user(user_id), query=query, offset='')
+        return Step(types.Update(update_id=next(self._update_ids), inline_query=inline_query),
+                    answer_id=query_id if wait_answer else None, timed=wait_answer, delay=delay)
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def drive(main, api: FakeBotAPI, sessions: List[List[Step]], concurrency: int, timeout: float) -> Dict:
+    """Прогоняет сессии через диспетчер: шаги одной сессии по очереди, сессии параллельно"""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+    lost = failed = 0
+    calls_before, errors_before = api.calls.copy(), api.errors.copy()
+
+    async def run_session(steps: List[Step]):
+        nonlocal lost, failed
+        async with semaphore:
+            for step in steps:
+                if step.delay:
+                    await asyncio.sleep(step.delay)
+                answer = api.expect_answer(step.answer_id) if step.answer_id else None
+                started = time.perf_counter()
+                try:
+                    await main.dp.feed_update(main.bot, step.update)
+                except Exception:
+                    # В боевом режиме ошибку обработчика поглощает диспетчер, здесь она только считается
+                    failed += 1
+                    if answer is not None and not answer.done():
+                        answer.cancel()
+                    continue
+                if answer is None:
+                    if step.timed:
+                        latencies.append(time.perf_counter() - started)
+                    continue
+                try:
+                    latencies.append(await asyncio.wait_for(answer, timeout) - started)
+                except asyncio.TimeoutError:
+                    lost += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(run_session(steps) for steps in sessions))
+    elapsed = time.perf_counter() - started
+    updates = sum(len(steps) for steps in sessions)
+    calls = api.calls - calls_before
+    return {
+        'updates': updates,
+        'seconds': round(elapsed, 3),
+        'updates_per_second': round(updates / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 1),
+        'unanswered': lost,
+        'handler_errors': failed,
+        'api_calls_per_update': round(sum(calls.values()) / updates, 2),
+        'api_calls': dict(calls.most_common()),
+        'injected_errors': dict(api.errors - errors_before),
+    }
+
+
+def new_contest(main, creator_id: int, number: int, active: bool = True) -> str:
+    contest_id = main.contest_ids.format(number, False)
+    main.register_contest(contest_id, {
+        'creator_id': creator_id,
+        'channel_id': FakeBotAPI._chat_id(f"@{CHANNEL}"),
+        'channel_username': CHANNEL,
+        'message_id': number,
+        'conditions': f"Конкурс №{number}",
+        'winner_count': 1,
+        'is_active': True,
+        'channels': [CHANNEL],
+    })
+    if not active:
+        main.finish_contest(contest_id)
+    return contest_id
+
+
+def join_storm(main, factory: UpdateFactory, args, numbers) -> List[List[Step]]:
+    contest_id = new_contest(main, 1, next(numbers))
+    data = main.JoinCallback(contest_id=contest_id).pack()
+    return [[factory.callback(10_000_000 + i, data, wait_answer=True)] for i in range(args.users)]
+
+
+def inline_flood(main, factory: UpdateFactory, args, numbers) -> List[List[Step]]:
+    contest_ids = [new_contest(main, 1, next(numbers)) for _ in range(10)]
+    sessions = []
+    for i in range(args.users):
+        user_id = 20_000_000 + i
+        if i % 2:
+            # Поиск по ID: ответ на каждую букву
+            text = contest_ids[i % len(contest_ids)]
+            sessions.append([
+                factory.inline(user_id, text[:n], wait_answer=True, delay=args.keystroke_interval if n > 1 else 0)
+                for n in range(1, len(text) + 1)
+            ])
+        else:
+            # ФАСТ конкурс: ответ только на последнюю букву после паузы в наборе
+            start = len('conc ') + 1
+            sessions.append([
+                factory.inline(
+                    user_id, FAST_QUERY[:n], wait_answer=n == len(FAST_QUERY),
+                    delay=args.keystroke_interval if n > start else 0
+                )
+                for n in range(start, len(FAST_QUERY) + 1)
+            ])
+    return sessions
+
+
+def start_menus(main, factory: UpdateFactory, args, numbers) -> List[List[Step]]:
+    creators = [30_000_000 + i for i in range(args.creators)]
+    for i in range(args.contests):
+        new_contest(main, creators[i % len(creators)], next(numbers), active=i % 2 == 0)
+    sessions = []
+    for i in range(args.users):
+        user_id = creators[i % len(creators)]
+        sessions.append([
+            factory.message(user_id, '/start'),
+            factory.callback(user_id, main.PickMenuCallback().pack()),
+            factory.callback(user_id, main.ContestPageCallback(kind='pick', page=1).pack()),
+            factory.callback(user_id, main.RerollMenuCallback().pack()),
+        ])
+    return sessions
+
+
+BUILDERS = {'join_storm': join_storm, 'inline_flood': inline_flood, 'start_menus': start_menus}
+
+
+def print_report(name: str, report: Dict) -> None:
+    print(f"\n== {name}")
+    print(f"Апдейтов: {report['updates']} за {report['seconds']} с ({report['updates_per_second']}/с)")
+    print(f"Задержка ответа: p50 {report['p50_ms']} мс, p99 {report['p99_ms']} мс, без ответа: {report['unanswered']}, "
+          f"ошибок обработчиков: {report['handler_errors']}")
+    print(f"Запросов к API на апдейт: {report['api_calls_per_update']}")
+    print("  " + ", ".join(f"{method}: {count}" for method, count in report['api_calls'].items()))
+    if report['injected_errors']:
+        print("Внесённые ошибки: " + ", ".join(f"{kind}: {count}" for kind, count in report['injected_errors'].items()))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--scenario', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--users', type=int, default=2000, help='пользователей (сессий) на сценарий')
+    parser.add_argument('--contests', type=int, default=10000, help='конкурсов в start_menus')
+    parser.add_argument('--creators', type=int, default=100, help='создателей этих конкурсов')
+    parser.add_argument('--concurrency', type=int, default=500, help='одновременных сессий')
+    parser.add_argument('--keystroke-interval', type=float, default=0.08, help='пауза между буквами inline-запроса')
+    parser.add_argument('--latency', type=float, default=0.03, help='задержка ответа API, с')
+    parser.add_argument('--jitter', type=float, default=0.02, help='случайная добавка к задержке, с')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='доля ответов 500')
+    parser.add_argument('--retry-after-rate', type=float, default=0.0, help='доля ответов 429')
+    parser.add_argument('--retry-after', type=int, default=1, help='retry_after в ответах 429, с')
+    parser.add_argument('--timeout', type=float, default=30, help='сколько ждать ответа на запрос')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='записать отчёт в файл для сравнения между версиями')
+    parser.add_argument('--log-level', default='CRITICAL', help='уровень логов бота')
+    return parser.parse_args()
+
+
+async def run(args) -> Dict[str, Dict]:
+    api = FakeBotAPI(args.latency, args.jitter, args.error_rate, args.retry_after_rate, args.retry_after, args.seed)
+    runner = web.AppRunner(api.app(), access_log=None)
+    await runner.setup()
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    await web.SockSite(runner, sock).start()
+
+    # Окружение бота задаётся до импорта: настройки читаются при загрузке модуля
+    os.environ['BOT_TOKEN'] = '123456:loadtest'
+    os.environ['TELEGRAM_API_URL'] = f"http://127.0.0.1:{sock.getsockname()[1]}"
+    os.environ['DB_PATH'] = os.path.join(tempfile.mkdtemp(prefix='loadtest-'), 'contests.db')
+    os.environ.pop('WEBHOOK_URL', None)
+    import main
+    logging.getLogger().setLevel(args.log_level.upper())
+
+    await main.on_startup()
+    reports = {}
+    try:
+        factory = UpdateFactory()
+        numbers = itertools.count(1)
+        for name in args.scenario:
+            sessions = BUILDERS[name](main, factory, args, numbers)
+            reports[name] = await drive(main, api, sessions, args.concurrency, args.timeout)
+            print_report(name, reports[name])
+    finally:
+        await main.on_shutdown()
+        await main.bot.session.close()
+        await runner.cleanup()
+    return reports
+
+
+def main() -> None:
+    args = parse_args()
+    reports = asyncio.run(run(args))
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'args': vars(args), 'reports': reports}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
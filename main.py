@@ -1,14 +1,37 @@
 import os
 import logging
 import asyncio
-import random
+import array
+import bisect
+import csv
+import hashlib
+import heapq
+import hmac
+import io
+import itertools
+import json
+import math
+import secrets
+import signal
+import sqlite3
 import uuid
+import zlib
 import sys
+import threading
+import time
+import traceback
+from collections import Counter as TallyCounter, OrderedDict, deque
 from datetime import datetime
-from typing import Dict, List, Set
+from typing import Any, AsyncIterator, Awaitable, Callable, Collection, Dict, Hashable, Iterable, Iterator, List, Optional, Set, Tuple, Type, Union
 from aiohttp import web
 from aiogram import Bot, Dispatcher, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.dispatcher.middlewares.base import BaseMiddleware
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 from aiogram.filters import Command, CommandStart
+from aiogram.filters.callback_data import CallbackData
 from aiogram.types import (
     Message,
     CallbackQuery,
@@ -16,13 +39,16 @@ from aiogram.types import (
     InlineKeyboardButton,
     InlineQuery,
     InlineQueryResultArticle,
+    InputFile,
     InputTextMessageContent
 )
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from dotenv import load_dotenv
+from pydantic import Field
 
 load_dotenv()  # Загружает переменные из .env для локальной разработки
 
@@ -45,11 +71,126 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
-bot = Bot(token=BOT_TOKEN)
+# Другой адрес Bot API: локальный telegram-bot-api или заглушка нагрузочного теста (loadtest.py)
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+bot = Bot(
+    token=BOT_TOKEN,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+)
 logging.info("✅ Токен успешно загружен")
 
 ADMIN_IDS = set(map(int, os.getenv('ADMIN_IDS', '').split(','))) if os.getenv('ADMIN_IDS') else set()
-dp = Dispatcher(storage=MemoryStorage())
+CHAT_CACHE_TTL = float(os.getenv('CHAT_CACHE_TTL', '3600'))  # username -> чат почти не меняется
+MEMBER_CACHE_TTL = float(os.getenv('MEMBER_CACHE_TTL', '60'))  # только положительные проверки подписки
+CACHE_MAX_SIZE = int(os.getenv('CACHE_MAX_SIZE', '50000'))
+SUBSCRIPTION_CHECK_CONCURRENCY = int(os.getenv('SUBSCRIPTION_CHECK_CONCURRENCY', '20'))  # на весь бот
+SUBSCRIPTION_CHECK_TIMEOUT = float(os.getenv('SUBSCRIPTION_CHECK_TIMEOUT', '5'))  # на одну проверку
+SUBSCRIPTION_CHECK_GRACE = float(os.getenv('SUBSCRIPTION_CHECK_GRACE', '1'))  # ожидание остальных после первого отказа
+LOOP_LAG_INTERVAL = float(os.getenv('LOOP_LAG_INTERVAL', '0.1'))
+LOOP_STALL_THRESHOLD = float(os.getenv('LOOP_STALL_THRESHOLD', '0.5'))  # блокировка цикла, после которой снимается стек
+SLOW_HANDLER_THRESHOLD = float(os.getenv('SLOW_HANDLER_THRESHOLD', '1'))
+PROFILE_MAX_SECONDS = float(os.getenv('PROFILE_MAX_SECONDS', '60'))
+DEBUG_TOKEN = os.getenv('DEBUG_TOKEN')  # без него /debug/* отключены
+JOIN_CONCURRENCY = int(os.getenv('JOIN_CONCURRENCY', '100'))  # заявок на участие, проверяемых одновременно
+JOIN_QUEUE_SIZE = int(os.getenv('JOIN_QUEUE_SIZE', '5000'))  # сверх этого - отказ "попробуй позже"
+JOIN_ANSWER_DEADLINE = float(os.getenv('JOIN_ANSWER_DEADLINE', '10'))  # после этого ответ на нажатие уже не дойдёт
+WINNER_LOOKUP_CONCURRENCY = int(os.getenv('WINNER_LOOKUP_CONCURRENCY', '5'))
+CONTEST_PICKER_PAGE_SIZE = int(os.getenv('CONTEST_PICKER_PAGE_SIZE', '8'))  # конкурсов на страницу меню
+PARTICIPANTS_PAGE_SIZE = int(os.getenv('PARTICIPANTS_PAGE_SIZE', '50'))  # строк на страницу, укладывается в 4096 символов
+INLINE_CACHE_TIME_ACTIVE = int(os.getenv('INLINE_CACHE_TIME_ACTIVE', '10'))  # кнопка может исчезнуть
+INLINE_CACHE_TIME_FINISHED = int(os.getenv('INLINE_CACHE_TIME_FINISHED', '300'))
+INLINE_CACHE_TIME_HELP = int(os.getenv('INLINE_CACHE_TIME_HELP', '300'))  # подсказки и ошибки формата
+FAST_DEBOUNCE = float(os.getenv('FAST_DEBOUNCE', '0.4'))  # пауза в наборе перед ответом на 'conc'
+FAST_DRAFT_TTL = float(os.getenv('FAST_DRAFT_TTL', '900'))  # сколько живёт предпросмотр ФАСТ конкурса
+# exact - множество id (точно, память растёт с аудиторией), hll - HyperLogLog (фиксированная память, ошибка ~1%)
+UNIQUE_USERS_MODE = os.getenv('UNIQUE_USERS_MODE', 'exact')
+HLL_PRECISION = int(os.getenv('HLL_PRECISION', '14'))  # 2^14 регистров = 16 КБ на счётчик, ошибка ~0.8%
+UNIQUE_USERS_DAYS = int(os.getenv('UNIQUE_USERS_DAYS', '7'))
+DB_PATH = os.getenv('DB_PATH', 'contests.db')
+# Ключ перестановки ID конкурсов (hex); без него генерируется и хранится в базе
+CONTEST_ID_KEY = os.getenv('CONTEST_ID_KEY')
+DB_FLUSH_INTERVAL = float(os.getenv('DB_FLUSH_INTERVAL', '0.5'))
+# Завершённые конкурсы без обращений дольше ARCHIVE_AFTER секунд выгружаются из памяти в архив; 0 - не выгружать
+ARCHIVE_AFTER = float(os.getenv('ARCHIVE_AFTER', str(7 * 24 * 3600)))
+ARCHIVE_CHECK_INTERVAL = float(os.getenv('ARCHIVE_CHECK_INTERVAL', '600'))
+# Несколько экземпляров бота с общей базой DB_PATH: участие записывается в базу сразу,
+# изменения других экземпляров подтягиваются раз в DB_FLUSH_INTERVAL
+SHARED_STATE = os.getenv('SHARED_STATE', '0') == '1'
+SHARED_SYNC_WINDOW = float(os.getenv('SHARED_SYNC_WINDOW', '5'))  # запас на запись, закоммиченную с опозданием
+FSM_STORAGE = os.getenv('FSM_STORAGE', 'sqlite' if SHARED_STATE else 'memory')  # memory | sqlite
+SEND_GLOBAL_RATE = float(os.getenv('SEND_GLOBAL_RATE', '30'))  # сообщений в секунду на бота
+SEND_CHAT_RATE = float(os.getenv('SEND_CHAT_RATE', '1'))  # сообщений в секунду в один чат
+SEND_CHAT_BURST = float(os.getenv('SEND_CHAT_BURST', '3'))
+SEND_MAX_RETRIES = int(os.getenv('SEND_MAX_RETRIES', '3'))
+WEB_PORT = int(os.getenv('PORT', '8080'))
+# Без WEBHOOK_URL бот работает через long polling (локальная разработка)
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '').rstrip('/')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+# Без явного значения выводится из токена: у всех экземпляров бота секрет один и тот же
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or hmac.new(BOT_TOKEN.encode(), b"webhook", hashlib.sha256).hexdigest()
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '8'))
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', '1000'))
+
+class SQLiteFSMStorage(BaseStorage):
+    """FSM в SQLite: мастер создания конкурса продолжается на любом экземпляре бота с той же базой"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS fsm (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT NOT NULL DEFAULT '{}'
+        );
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        # Соединение открывается при первом обращении, из цикла событий
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(self.SCHEMA)
+        return self._conn
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:{key.destiny}"
+
+    async def _query(self, sql: str, params: Tuple) -> Optional[Tuple]:
+        conn = self.conn
+        return await asyncio.to_thread(lambda: conn.execute(sql, params).fetchone())
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        value = state.state if isinstance(state, State) else state
+        await self._query(
+            "INSERT INTO fsm (key, state) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET state = excluded.state",
+            (self._key(key), value)
+        )
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        row = await self._query("SELECT state FROM fsm WHERE key = ?", (self._key(key),))
+        return row[0] if row else None
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        await self._query(
+            "INSERT INTO fsm (key, data) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET data = excluded.data",
+            (self._key(key), json.dumps(data, ensure_ascii=False))
+        )
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        row = await self._query("SELECT data FROM fsm WHERE key = ?", (self._key(key),))
+        return json.loads(row[0]) if row else {}
+
+    async def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+dp = Dispatcher(storage=SQLiteFSMStorage(DB_PATH) if FSM_STORAGE == 'sqlite' else MemoryStorage())
 
 # ===== СОСТОЯНИЯ FSM =====
 class ContestStates(StatesGroup):
@@ -59,33 +200,2281 @@ class ContestStates(StatesGroup):
     waiting_for_winner_count = State()
     waiting_for_target_channel = State()
     waiting_for_winners = State()
+    waiting_for_reroll_slots = State()
     waiting_for_results_link = State()
 
+# ===== CALLBACK DATA =====
+ContestId = Field(pattern=r'^F?\d{6}$')
+
+class NewContestCallback(CallbackData, prefix="new_contest"):
+    pass
+
+class ConfirmCallback(CallbackData, prefix="confirm"):
+    winner_count: int = Field(gt=0)
+
+class CancelCallback(CallbackData, prefix="cancel"):
+    pass
+
+class JoinCallback(CallbackData, prefix="join"):
+    contest_id: str = ContestId
+
+class StatsCallback(CallbackData, prefix="stats"):
+    pass
+
+class PickMenuCallback(CallbackData, prefix="pick_winners"):
+    pass
+
+class RerollMenuCallback(CallbackData, prefix="reroll_winners"):
+    pass
+
+class PickCallback(CallbackData, prefix="pick"):
+    contest_id: str = ContestId
+
+class RerollCallback(CallbackData, prefix="reroll"):
+    contest_id: str = ContestId
+
+class DrawCallback(CallbackData, prefix="draw"):
+    contest_id: str = ContestId
+
+class RedrawCallback(CallbackData, prefix="redraw"):
+    contest_id: str = ContestId
+
+class ContestPageCallback(CallbackData, prefix="cpage"):
+    kind: str = Field(pattern=r'^(pick|reroll)$')
+    page: int = Field(ge=0)
+
+class CancelPickCallback(CallbackData, prefix="cancel_pick"):
+    pass
+
+class CancelRerollCallback(CallbackData, prefix="cancel_reroll"):
+    pass
+
+class ParticipantsPageCallback(CallbackData, prefix="pp"):
+    contest_id: str = ContestId
+    page: int = Field(ge=0)
+
+class ParticipantsExportCallback(CallbackData, prefix="pexp"):
+    contest_id: str = ContestId
+
+class FastPublishCallback(CallbackData, prefix="fpub"):
+    key: str = Field(pattern=r'^[0-9a-f]{16}$')
+
+class CallbackRouter:
+    """Маршрутизация нажатий по префиксу callback_data: один поиск в словаре вместо цепочки фильтров.
+
+    Данные разбираются фабрикой CallbackData один раз и передаются обработчику как callback_data.
+    """
+
+    def __init__(self):
+        self.routes: Dict[str, Tuple[Type[CallbackData], Callable]] = {}
+
+    def route(self, factory: Type[CallbackData]):
+        def decorator(handler: Callable) -> Callable:
+            if factory.__prefix__ in self.routes:
+                raise ValueError(f"Префикс {factory.__prefix__!r} уже зарегистрирован")
+            self.routes[factory.__prefix__] = (factory, handler)
+            return handler
+        return decorator
+
+    def resolve(self, data: Optional[str]) -> Optional[Tuple[Type[CallbackData], Callable]]:
+        return self.routes.get((data or "").split(":", 1)[0])
+
+    def handler_name(self, data: Optional[str]) -> str:
+        route = self.resolve(data)
+        return route[1].__name__ if route else 'unknown_callback'
+
+    async def dispatch(self, call: CallbackQuery, state: FSMContext):
+        route = self.resolve(call.data)
+        if route is None:
+            await bot.answer_callback_query(call.id, "⚠️ Кнопка устарела")
+            return
+        factory, handler = route
+        try:
+            callback_data = factory.unpack(call.data)
+        except (TypeError, ValueError) as e:
+            logging.warning(f"Некорректные данные кнопки {call.data!r}: {e}")
+            await bot.answer_callback_query(call.id, "⚠️ Кнопка устарела")
+            return
+        await handler(call, callback_data, state)
+
+callback_router = CallbackRouter()
+
+@dp.callback_query()
+async def route_callback(call: CallbackQuery, state: FSMContext):
+    await callback_router.dispatch(call, state)
+
+# ===== РЕЕСТР УЧАСТНИКОВ =====
+class ParticipantRegistry:
+    """Участники одного конкурса в порядке вступления, по колонкам.
+
+    id хранятся в array('q') по 8 байт, username и имена интернируются, так что
+    повторяющиеся строки хранятся один раз. Словари участников собираются только
+    при чтении. Индексы позиций по id и username нужны лишь при подведении итогов
+    (ввод победителей, перевыбор мест) и строятся при первом поиске.
+    """
+
+    __slots__ = ('_ids', '_usernames', '_names', '_members', '_by_id', '_by_username')
+
+    def __init__(self):
+        self._ids = array.array('q')
+        self._usernames: List[Optional[str]] = []
+        self._names: List[str] = []
+        self._members: Set[int] = set()
+        self._by_id: Optional[Dict[int, int]] = None
+        self._by_username: Optional[Dict[str, int]] = None
+
+    @staticmethod
+    def _username_key(username: str) -> str:
+        # Username в Telegram регистронезависимы
+        return username.lstrip('@').lower()
+
+    def add(self, user_id: int, username: Optional[str], name: str) -> bool:
+        """Добавляет участника. Возвращает False, если он уже зарегистрирован"""
+        if user_id in self._members:
+            return False
+        self._members.add(user_id)
+        if self._by_id is not None:
+            self._by_id[user_id] = len(self._ids)
+        if username and self._by_username is not None:
+            self._by_username[self._username_key(username)] = len(self._ids)
+        self._ids.append(user_id)
+        self._usernames.append(sys.intern(username) if username else None)
+        self._names.append(sys.intern(name))
+        return True
+
+    def _record(self, position: int) -> Dict:
+        return {'user_id': self._ids[position], 'username': self._usernames[position], 'name': self._names[position]}
+
+    def index_of(self, user_id: int) -> Optional[int]:
+        """Позиция участника в порядке вступления"""
+        if user_id not in self._members:
+            return None
+        if self._by_id is None:
+            self._by_id = {uid: position for position, uid in enumerate(self._ids)}
+        return self._by_id[user_id]
+
+    def get(self, user_id: int) -> Optional[Dict]:
+        position = self.index_of(user_id)
+        return self._record(position) if position is not None else None
+
+    def get_by_username(self, username: str) -> Optional[Dict]:
+        if self._by_username is None:
+            self._by_username = {
+                self._username_key(name): position
+                for position, name in enumerate(self._usernames) if name
+            }
+        position = self._by_username.get(self._username_key(username))
+        return self._record(position) if position is not None else None
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._members
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __iter__(self) -> Iterator[Dict]:
+        return map(self._record, range(len(self._ids)))
+
+    def __getitem__(self, position: int) -> Dict:
+        return self._record(range(len(self._ids))[position])
+
+    def page(self, start: int, stop: int) -> List[Dict]:
+        """Участники с позиции start по stop (не включая) в порядке вступления"""
+        return [self._record(position) for position in range(len(self._ids))[start:stop]]
+
+    def digest(self) -> str:
+        """SHA-256 от id участников в порядке вступления (по 8 байт, big-endian)"""
+        ids = array.array('q', self._ids)
+        if sys.byteorder == 'little':
+            ids.byteswap()
+        return hashlib.sha256(ids.tobytes()).hexdigest()
+
+    def columns(self) -> Tuple[List[int], List[Optional[str]], List[str]]:
+        """Копии колонок (id, username, имена) для архива"""
+        return self._ids.tolist(), list(self._usernames), list(self._names)
+
+    @classmethod
+    def from_columns(cls, ids: List[int], usernames: List[Optional[str]], names: List[str]) -> 'ParticipantRegistry':
+        registry = cls()
+        for user_id, username, name in zip(ids, usernames, names):
+            registry.add(user_id, username, name)
+        return registry
+
+class ArchivedContest:
+    """То, что остаётся в памяти от конкурса в архиве: хватает для меню пересмотра итогов"""
+    __slots__ = ('creator_id', 'is_fast', 'channel_id', 'channel_username')
+
+    def __init__(self, creator_id: int, is_fast: bool, channel_id: int, channel_username: Optional[str]):
+        self.creator_id = creator_id
+        self.is_fast = is_fast
+        self.channel_id = channel_id
+        self.channel_username = channel_username
+
+# ===== РОЗЫГРЫШ =====
+def _draw_stream(seed: bytes) -> Iterator[int]:
+    """Детерминированный поток 64-битных чисел: HMAC-SHA256(seed, номер блока)"""
+    for block in itertools.count():
+        digest = hmac.new(seed, block.to_bytes(8, 'big'), hashlib.sha256).digest()
+        for offset in range(0, len(digest), 8):
+            yield int.from_bytes(digest[offset:offset + 8], 'big')
+
+def _uniform_below(stream: Iterator[int], n: int) -> int:
+    """Равномерное число из range(n) без смещения по модулю"""
+    limit = (1 << 64) - (1 << 64) % n
+    while True:
+        value = next(stream)
+        if value < limit:
+            return value % n
+
+def draw_indices(seed: bytes, population: int, k: int, exclude: Collection[int] = ()) -> List[int]:
+    """Выбирает до k разных позиций из range(population), пропуская позиции из exclude.
+
+    Частичная перетасовка Фишера-Йетса, где переставленные элементы хранятся в словаре,
+    поэтому память O(k + len(exclude)) при любом числе участников. Результат зависит
+    только от seed, population и exclude - по опубликованному seed розыгрыш можно повторить.
+    """
+    stream = _draw_stream(seed)
+    excluded = set(exclude)
+    swaps: Dict[int, int] = {}
+    result: List[int] = []
+    for i in range(population):
+        if len(result) >= k:
+            break
+        j = i + _uniform_below(stream, population - i)
+        picked = swaps.get(j, j)
+        swaps[j] = swaps.pop(i, i)
+        if picked not in excluded:
+            result.append(picked)
+    return result
+
+def new_draw_seed() -> bytes:
+    return secrets.token_bytes(16)
+
+def format_draw_commitment(seed_hex: str) -> str:
+    """Строка поста с SHA-256 от seed: публикуется вместе с конкурсом, до розыгрыша"""
+    return f"🔒 SHA-256 seed розыгрыша: {hashlib.sha256(bytes.fromhex(seed_hex)).hexdigest()}"
+
+def round_seed(seed: bytes, round_number: int) -> bytes:
+    """Seed розыгрыша номер round_number: 0 - основной, дальше - перевыборы.
+
+    Все раунды выводятся из заявленного заранее seed, поэтому повторное нажатие
+    даёт тот же результат, а не новый вариант на выбор.
+    """
+    if round_number == 0:
+        return seed
+    return hmac.new(seed, f"round:{round_number}".encode(), hashlib.sha256).digest()[:16]
+
+# ===== ИДЕНТИФИКАТОРЫ КОНКУРСОВ =====
+class FeistelPermutation:
+    """Псевдослучайная перестановка чисел [0, size) по секретному ключу.
+
+    Сеть Фейстеля с раундовой функцией на HMAC-SHA256 - биекция на 2^bits значений;
+    выходы за size пропускаются повторным шифрованием (cycle walking), в среднем
+    меньше двух шагов. Разные входы всегда дают разные выходы, по выходу без ключа
+    нельзя узнать номер или соседние значения.
+    """
+
+    ROUNDS = 4
+
+    def __init__(self, key: bytes, size: int):
+        self.key = key
+        self.size = size
+        bits = max(2, (size - 1).bit_length())
+        self.half = (bits + 1) // 2
+        self.mask = (1 << self.half) - 1
+
+    def _round(self, index: int, value: int) -> int:
+        digest = hmac.new(self.key, f"{index}:{value}".encode(), hashlib.sha256).digest()
+        return int.from_bytes(digest[:8], 'big') & self.mask
+
+    def _encrypt(self, value: int) -> int:
+        left, right = value >> self.half, value & self.mask
+        for index in range(self.ROUNDS):
+            left, right = right, left ^ self._round(index, right)
+        return (left << self.half) | right
+
+    def permute(self, number: int) -> int:
+        if not 0 <= number < self.size:
+            raise ValueError(f"Номер {number} вне диапазона [0, {self.size})")
+        value = self._encrypt(number)
+        while value >= self.size:
+            value = self._encrypt(value)
+        return value
+
+class ContestIdAllocator:
+    """ID конкурсов: номер из общего счётчика в базе, пропущенный через перестановку.
+
+    Формат прежний - 6 цифр, у ФАСТ конкурсов с префиксом F; у обычных и ФАСТ свои
+    счётчики и ключи перестановки.
+    """
+
+    FIRST = 100000
+    SPACE = 900000
+
+    def __init__(self):
+        self._permutations: Dict[bool, FeistelPermutation] = {}
+
+    def configure(self, key: bytes) -> None:
+        self._permutations = {
+            is_fast: FeistelPermutation(
+                hmac.new(key, b"fast" if is_fast else b"regular", hashlib.sha256).digest(), self.SPACE
+            )
+            for is_fast in (False, True)
+        }
+
+    def format(self, number: int, is_fast: bool) -> str:
+        if number >= self.SPACE:
+            raise RuntimeError("Свободные ID конкурсов закончились")
+        value = self.FIRST + self._permutations[is_fast].permute(number)
+        return f"F{value}" if is_fast else str(value)
+
+contest_ids = ContestIdAllocator()
+
+# ===== КЭШ ЗАПРОСОВ К TELEGRAM =====
+SUBSCRIBED_STATUSES = ("member", "administrator", "creator")
+_MISSING = object()
+
+class TTLCache:
+    """LRU-кэш с ограниченным размером и временем жизни записей.
+
+    Одновременные промахи по одному ключу объединяются (single-flight):
+    загрузчик вызывается один раз, остальные ждут его результат.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key: Hashable) -> None:
+        self._data.pop(key, None)
+
+    async def get_or_load(
+        self,
+        key: Hashable,
+        loader: Callable[[], Awaitable[Any]],
+        should_cache: Callable[[Any], bool] = lambda value: True
+    ) -> Any:
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            self.hits += 1
+            return value
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+            return await asyncio.shield(task)
+
+        self.misses += 1
+        task = asyncio.ensure_future(loader())
+        self._inflight[key] = task
+
+        def _done(t: asyncio.Future):
+            self._inflight.pop(key, None)
+            if not t.cancelled() and t.exception() is None and should_cache(t.result()):
+                self.set(key, t.result())
+
+        task.add_done_callback(_done)
+        return await asyncio.shield(task)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced
+        }
+
+chat_cache = TTLCache(CACHE_MAX_SIZE, CHAT_CACHE_TTL)
+member_cache = TTLCache(CACHE_MAX_SIZE, MEMBER_CACHE_TTL)
+# Готовые inline-карточки конкурсов; обновляются при изменении конкурса, а не по времени
+inline_cache = TTLCache(CACHE_MAX_SIZE, float('inf'))
+
+async def get_chat_cached(chat_ref):
+    """bot.get_chat через кэш. chat_ref - '@username' или числовой id"""
+    async def load():
+        chat = await bot.get_chat(chat_ref)
+        if isinstance(chat_ref, str):
+            # Тот же чат потом запрашивается по id (inline-режим, меню итогов)
+            chat_cache.set(chat.id, chat)
+        return chat
+
+    key = chat_ref.lower() if isinstance(chat_ref, str) else chat_ref
+    return await chat_cache.get_or_load(key, load)
+
+async def get_member_status_cached(chat_id: int, user_id: int) -> str:
+    """Статус участника канала. В кэш попадают только подписанные пользователи"""
+    async def load() -> str:
+        member = await bot.get_chat_member(chat_id, user_id)
+        return member.status
+
+    return await member_cache.get_or_load(
+        (chat_id, user_id),
+        load,
+        should_cache=lambda status: status in SUBSCRIBED_STATUSES
+    )
+
+# ===== ПРОВЕРКА ПОДПИСОК =====
+subscription_semaphore = asyncio.Semaphore(SUBSCRIPTION_CHECK_CONCURRENCY)
+
+async def is_subscribed(chat_ref: Union[str, int], user_id: int) -> bool:
+    async def check() -> bool:
+        chat = await get_chat_cached(chat_ref)
+        return await get_member_status_cached(chat.id, user_id) in SUBSCRIBED_STATUSES
+
+    # Ожидание очереди к семафору не считается в таймаут: ограничены только запросы к API
+    async with subscription_semaphore:
+        return await asyncio.wait_for(check(), SUBSCRIPTION_CHECK_TIMEOUT)
+
+async def find_missing_subscriptions(
+    channels: List[Tuple[str, Union[str, int]]], user_id: int
+) -> Tuple[List[str], List[str]]:
+    """Параллельно проверяет подписки. Возвращает названия каналов без подписки и непроверенных.
+
+    channels - пары (название для ответа, '@username' или id чата). Когда первый отказ
+    подтверждён, остальные проверки ждут не дольше SUBSCRIPTION_CHECK_GRACE. Не успевшие,
+    упавшие по таймауту или с ошибкой каналы считаются непроверенными, а не отсутствующими.
+    """
+    loop = asyncio.get_running_loop()
+    tasks = {
+        asyncio.ensure_future(is_subscribed(ref, user_id)): index
+        for index, (_, ref) in enumerate(channels)
+    }
+    missing: Set[int] = set()
+    unverified: Set[int] = set()
+    pending = set(tasks)
+    deadline = None
+    try:
+        while pending:
+            timeout = None if deadline is None else max(deadline - loop.time(), 0)
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                break
+            for task in done:
+                if task.cancelled() or task.exception() is not None:
+                    unverified.add(tasks[task])
+                elif not task.result():
+                    missing.add(tasks[task])
+            if missing and deadline is None:
+                deadline = loop.time() + SUBSCRIPTION_CHECK_GRACE
+    finally:
+        for task in pending:
+            task.cancel()
+            unverified.add(tasks[task])
+    return (
+        [channels[index][0] for index in sorted(missing)],
+        [channels[index][0] for index in sorted(unverified)]
+    )
+
+# ===== УНИКАЛЬНЫЕ ПОЛЬЗОВАТЕЛИ =====
+class ExactCounter:
+    """Точный счётчик уникальных id"""
+
+    __slots__ = ('_ids',)
+    approximate = False
+
+    def __init__(self):
+        self._ids: Set[int] = set()
+
+    def add(self, value: int) -> bool:
+        """True, если значение встретилось впервые"""
+        if value in self._ids:
+            return False
+        self._ids.add(value)
+        return True
+
+    def count(self) -> int:
+        return len(self._ids)
+
+    def merge(self, other: 'ExactCounter') -> None:
+        self._ids |= other._ids
+
+    def to_bytes(self) -> bytes:
+        return array.array('q', self._ids).tobytes()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'ExactCounter':
+        counter = cls()
+        counter._ids.update(array.array('q', data))
+        return counter
+
+def _mix64(value: int) -> int:
+    """splitmix64: id пользователей идут почти подряд, HyperLogLog нужны равномерные биты"""
+    z = (value + 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+    return z ^ (z >> 31)
+
+class HyperLogLog:
+    """Приблизительный счётчик уникальных значений в 2^precision байтах.
+
+    Объединение - поэлементный максимум регистров, поэтому счётчики разных дней
+    и разных экземпляров бота складываются без потерь точности.
+    """
+
+    __slots__ = ('precision', 'registers')
+    approximate = True
+    SMALL_ALPHA = {16: 0.673, 32: 0.697, 64: 0.709}
+
+    def __init__(self, precision: int = HLL_PRECISION):
+        if not 4 <= precision <= 18:
+            raise ValueError(f"Точность HyperLogLog должна быть от 4 до 18, получено {precision}")
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, value: int) -> bool:
+        """True, если изменился регистр (значение могло быть новым)"""
+        h = _mix64(value)
+        index = h >> (64 - self.precision)
+        rest_bits = 64 - self.precision
+        rank = rest_bits - (h & ((1 << rest_bits) - 1)).bit_length() + 1
+        if rank <= self.registers[index]:
+            return False
+        self.registers[index] = rank
+        return True
+
+    def count(self) -> int:
+        m = len(self.registers)
+        # Приближённая формула alpha верна с 128 регистров, для меньших - табличные значения
+        alpha = self.SMALL_ALPHA.get(m) or 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)  # линейный подсчёт на малых значениях
+        return round(estimate)
+
+    def merge(self, other: 'HyperLogLog') -> None:
+        if other.precision != self.precision:
+            raise ValueError("Нельзя объединить HyperLogLog разной точности")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def to_bytes(self) -> bytes:
+        return bytes([self.precision]) + bytes(self.registers)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'HyperLogLog':
+        counter = cls(data[0])
+        if len(data) != len(counter.registers) + 1:
+            raise ValueError("Повреждённое состояние HyperLogLog")
+        counter.registers[:] = data[1:]
+        return counter
+
+def new_unique_counter() -> Union[ExactCounter, HyperLogLog]:
+    return HyperLogLog(HLL_PRECISION) if UNIQUE_USERS_MODE == 'hll' else ExactCounter()
+
+def unique_counter_from_bytes(data: bytes) -> Union[ExactCounter, HyperLogLog]:
+    return HyperLogLog.from_bytes(data) if UNIQUE_USERS_MODE == 'hll' else ExactCounter.from_bytes(data)
+
+def utc_day(timestamp: Optional[float] = None) -> str:
+    return time.strftime('%Y-%m-%d', time.gmtime(timestamp))
+
+class UniqueUsers:
+    """Уникальные пользователи бота: за всё время и по дням за последние UNIQUE_USERS_DAYS"""
+
+    def __init__(self):
+        self.total = new_unique_counter()
+        self.days: Dict[str, Union[ExactCounter, HyperLogLog]] = {}
+
+    def day(self, day: str) -> Union[ExactCounter, HyperLogLog]:
+        counter = self.days.get(day)
+        if counter is None:
+            counter = self.days[day] = new_unique_counter()
+            cutoff = utc_day(time.time() - UNIQUE_USERS_DAYS * 86400)
+            for old in [d for d in self.days if d <= cutoff]:
+                del self.days[old]
+        return counter
+
+    def add(self, user_id: int) -> Optional[str]:
+        """Отмечает пользователя; возвращает день, если состояние изменилось и его нужно сохранить"""
+        day = utc_day()
+        changed = self.total.add(user_id)
+        changed = self.day(day).add(user_id) or changed
+        return day if changed else None
+
+    def count(self) -> int:
+        return self.total.count()
+
+    def count_days(self, days: int) -> int:
+        """Уникальные за последние days дней (включая сегодня)"""
+        now = time.time()
+        merged = new_unique_counter()
+        for offset in range(days):
+            counter = self.days.get(utc_day(now - offset * 86400))
+            if counter is not None:
+                merged.merge(counter)
+        return merged.count()
+
+# ===== ХРАНИЛИЩЕ =====
+class Storage:
+    """SQLite (WAL) хранилище конкурсов, участников и ссылок на итоги.
+
+    Обработчики только отмечают изменения в памяти, запись идёт пачками в отдельном
+    потоке раз в DB_FLUSH_INTERVAL. Каждая пачка - одна транзакция, поэтому после
+    падения база остаётся согласованной, теряются максимум изменения последнего интервала.
+
+    В режиме SHARED_STATE участие записывается сразу (join), а изменения других экземпляров
+    подтягиваются инкрементально (sync): конкурсы по времени изменения, участники по rowid.
+    Конкурс пишется не целиком, а только изменёнными с последней синхронизации полями поверх
+    строки в базе (_merge), чтобы устаревшая копия не затёрла чужое завершение.
+
+    Давно не использованные завершённые конкурсы переносятся в таблицу archive одной сжатой
+    записью (archive) и возвращаются в рабочие таблицы при первом обращении (restore).
+    """
+
+    STATS_SAVE_INTERVAL = 60  # ряды статистики пишутся не чаще, их потеря - минута данных
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS contests (
+            contest_id TEXT PRIMARY KEY,
+            data TEXT NOT NULL,
+            updated REAL NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS participants (
+            contest_id TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            username TEXT,
+            name TEXT NOT NULL,
+            PRIMARY KEY (contest_id, user_id)
+        );
+        CREATE TABLE IF NOT EXISTS results_links (
+            contest_id TEXT PRIMARY KEY,
+            url TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS unique_users (
+            user_id INTEGER PRIMARY KEY
+        );
+        CREATE TABLE IF NOT EXISTS unique_users_daily (
+            day TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            PRIMARY KEY (day, user_id)
+        );
+        CREATE TABLE IF NOT EXISTS meta (
+            name TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS sequences (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS unique_counters (
+            name TEXT PRIMARY KEY,
+            data BLOB NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS archive (
+            contest_id TEXT PRIMARY KEY,
+            creator_id INTEGER NOT NULL,
+            is_fast INTEGER NOT NULL,
+            channel_id INTEGER NOT NULL,
+            channel_username TEXT,
+            participants INTEGER NOT NULL,
+            data BLOB NOT NULL
+        );
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.conn: Optional[sqlite3.Connection] = None
+        self._lock = asyncio.Lock()
+        self._dirty_contests: Set[str] = set()
+        self._joins: List[Tuple[str, int, Optional[str], str]] = []
+        self._links: Dict[str, str] = {}
+        self._users: Set[Tuple[int, str]] = set()
+        self._dirty_counters: Set[str] = set()
+        self._synced_at = 0.0
+        self._participant_rowid = 0
+        # SHARED_STATE: версия конкурса, совпадающая с базой, - основа для записи изменённых полей
+        self._stored: Dict[str, str] = {}
+        self._stats_saved_at = time.monotonic()
+
+    def open(self) -> None:
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(contests)")}
+        if 'updated' not in columns:
+            self.conn.execute("ALTER TABLE contests ADD COLUMN updated REAL NOT NULL DEFAULT 0")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS contests_updated ON contests (updated)")
+        check = self.conn.execute("PRAGMA quick_check").fetchone()[0]
+        if check != "ok":
+            logging.error(f"🚨 База {self.path} повреждена: {check}")
+        logging.info(f"💾 База данных открыта: {self.path}")
+
+    def load(self) -> None:
+        """Загружает состояние из базы в глобальные словари"""
+        archived_participants = 0
+        # Архивные конкурсы старше рабочих, поэтому идут в индексе первыми
+        for contest_id, creator_id, is_fast, channel_id, channel_username, count in self.conn.execute(
+            "SELECT contest_id, creator_id, is_fast, channel_id, channel_username, participants FROM archive ORDER BY rowid"
+        ):
+            archived_contests[contest_id] = ArchivedContest(creator_id, bool(is_fast), channel_id, channel_username)
+            finished_by_creator.setdefault(creator_id, {})[contest_id] = None
+            archived_participants += count
+        now = time.time()
+        for contest_id, data, updated in self.conn.execute("SELECT contest_id, data, updated FROM contests"):
+            contests[contest_id] = json.loads(data)
+            if SHARED_STATE:
+                self._stored[contest_id] = data
+            participants[contest_id] = ParticipantRegistry()
+            index_contest(contest_id)
+            if not contests[contest_id]['is_active']:
+                contest_last_used[contest_id] = contests[contest_id].get('finished_at', now)
+            self._synced_at = max(self._synced_at, updated)
+        rows = self.conn.execute(
+            "SELECT rowid, contest_id, user_id, username, name FROM participants ORDER BY rowid"
+        )
+        for rowid, contest_id, user_id, username, name in rows:
+            participants.setdefault(contest_id, ParticipantRegistry()).add(user_id, username, name)
+            self._participant_rowid = rowid
+        bot_stats.participants = sum(len(registry) for registry in participants.values()) + archived_participants
+        results_links.update(self.conn.execute("SELECT contest_id, url FROM results_links"))
+        row = self.conn.execute("SELECT value FROM meta WHERE name = 'bot_stats'").fetchone()
+        if row:
+            bot_stats.load_state(row[0])
+        self._load_unique_users()
+        logging.info(
+            f"💾 Загружено конкурсов: {len(contests)}, "
+            f"участников: {sum(len(r) for r in participants.values())}, "
+            f"в архиве: {len(archived_contests)}"
+        )
+
+    def _load_unique_users(self) -> None:
+        cutoff = utc_day(time.time() - UNIQUE_USERS_DAYS * 86400)
+        if UNIQUE_USERS_MODE == 'hll':
+            self.conn.execute("DELETE FROM unique_counters WHERE name LIKE 'day:%' AND name <= ?", (f"day:{cutoff}",))
+            for name, data in self.conn.execute("SELECT name, data FROM unique_counters"):
+                counter = unique_counter_from_bytes(data)
+                if name == 'total':
+                    unique_users.total = counter
+                else:
+                    unique_users.days[name[len('day:'):]] = counter
+            if not unique_users.count():
+                # Переход с точного режима: HyperLogLog строится один раз из сохранённых id
+                for (user_id,) in self.conn.execute("SELECT user_id FROM unique_users"):
+                    unique_users.total.add(user_id)
+                self._dirty_counters.add('total')
+                for day, user_id in self.conn.execute(
+                    "SELECT day, user_id FROM unique_users_daily WHERE day > ?", (cutoff,)
+                ):
+                    unique_users.day(day).add(user_id)
+                    self._dirty_counters.add(f"day:{day}")
+            return
+        self.conn.execute("DELETE FROM unique_users_daily WHERE day <= ?", (cutoff,))
+        for (user_id,) in self.conn.execute("SELECT user_id FROM unique_users"):
+            unique_users.total.add(user_id)
+        for day, user_id in self.conn.execute("SELECT day, user_id FROM unique_users_daily"):
+            unique_users.day(day).add(user_id)
+
+    # --- отметки об изменениях (вызываются из обработчиков, без ввода-вывода) ---
+    def save_contest(self, contest_id: str) -> None:
+        self._dirty_contests.add(contest_id)
+
+    def add_participant(self, contest_id: str, user_id: int, username: Optional[str], name: str) -> None:
+        self._joins.append((contest_id, user_id, username, name))
+
+    def save_results_link(self, contest_id: str, url: str) -> None:
+        self._links[contest_id] = url
+
+    def add_user(self, user_id: int, day: str) -> None:
+        if UNIQUE_USERS_MODE == 'hll':
+            # Пишется состояние счётчиков целиком, не чаще раза за сброс
+            self._dirty_counters.update(('total', f"day:{day}"))
+        else:
+            self._users.add((user_id, day))
+
+    @property
+    def has_pending(self) -> bool:
+        return bool(self._dirty_contests or self._joins or self._links or self._users or self._dirty_counters)
+
+    # --- запись ---
+    @staticmethod
+    def _merge(current: str, base: Optional[str], local: str) -> str:
+        """Переносит поля, изменённые локально относительно base, на версию конкурса из базы"""
+        merged = json.loads(current)
+        finished = not merged['is_active']
+        local_contest = json.loads(local)
+        base_contest = json.loads(base) if base is not None else {}
+        for key, value in local_contest.items():
+            if key not in base_contest or base_contest[key] != value:
+                merged[key] = value
+        for key in base_contest.keys() - local_contest.keys():
+            merged.pop(key, None)
+        if finished:
+            # Завершённый конкурс не возвращается в активные ни при каком порядке записей
+            merged['is_active'] = False
+        return json.dumps(merged, ensure_ascii=False)
+
+    def _write(self, contest_rows, joins, links, users, counters, meta=(), bases=None) -> Dict[str, str]:
+        """Пишет пачку изменений; возвращает записанные версии конкурсов"""
+        written = {}
+        with self.conn:
+            # IMMEDIATE: транзакция читает до записи, и отложенная блокировка падала бы
+            # с "database is locked", если другой экземпляр успел закоммитить
+            self.conn.execute("BEGIN IMMEDIATE")
+            for contest_id, data, updated in contest_rows:
+                # Другой экземпляр мог убрать конкурс в архив, пока этот держал его в памяти
+                self._unarchive(contest_id)
+                if bases is not None:
+                    row = self.conn.execute("SELECT data FROM contests WHERE contest_id = ?", (contest_id,)).fetchone()
+                    if row:
+                        data = self._merge(row[0], bases.get(contest_id), data)
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO contests (contest_id, data, updated) VALUES (?, ?, ?)",
+                    (contest_id, data, updated)
+                )
+                written[contest_id] = data
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO participants (contest_id, user_id, username, name) VALUES (?, ?, ?, ?)",
+                joins
+            )
+            self.conn.executemany("INSERT OR REPLACE INTO results_links (contest_id, url) VALUES (?, ?)", links)
+            self.conn.executemany("INSERT OR IGNORE INTO unique_users (user_id) VALUES (?)", [(u,) for u, _ in users])
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO unique_users_daily (day, user_id) VALUES (?, ?)", [(d, u) for u, d in users]
+            )
+            for name, data in counters:
+                # Объединение с сохранённым: другие экземпляры могли записать свои регистры
+                row = self.conn.execute("SELECT data FROM unique_counters WHERE name = ?", (name,)).fetchone()
+                if row:
+                    counter = unique_counter_from_bytes(data)
+                    counter.merge(unique_counter_from_bytes(row[0]))
+                    data = counter.to_bytes()
+                self.conn.execute("INSERT OR REPLACE INTO unique_counters (name, data) VALUES (?, ?)", (name, data))
+            self.conn.executemany("INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)", meta)
+        return written
+
+    async def flush(self, save_stats: bool = False) -> None:
+        async with self._lock:
+            save_stats = save_stats or time.monotonic() - self._stats_saved_at >= self.STATS_SAVE_INTERVAL
+            if self.conn is None or not (self.has_pending or save_stats):
+                return
+            meta = [('bot_stats', bot_stats.state())] if save_stats else []
+            dirty, self._dirty_contests = self._dirty_contests, set()
+            joins, self._joins = self._joins, []
+            links, self._links = self._links, {}
+            users, self._users = self._users, set()
+            counter_names, self._dirty_counters = self._dirty_counters, set()
+            counters = []
+            for name in counter_names:
+                counter = unique_users.total if name == 'total' else unique_users.days.get(name[len('day:'):])
+                if counter is not None:
+                    counters.append((name, counter.to_bytes()))
+            # Снимок конкурсов делается в цикле событий, чтобы не читать словари из другого потока
+            now = time.time()
+            contest_rows = [
+                (cid, json.dumps(contests[cid], ensure_ascii=False), now) for cid in dirty if cid in contests
+            ]
+            bases = {cid: self._stored.get(cid) for cid, _, _ in contest_rows} if SHARED_STATE else None
+            try:
+                written = await asyncio.to_thread(
+                    self._write, contest_rows, joins, list(links.items()), list(users), counters, meta, bases
+                )
+                if save_stats:
+                    self._stats_saved_at = time.monotonic()
+            except Exception as e:
+                logging.error(f"Ошибка записи в базу, повтор при следующем сбросе: {e}")
+                self._dirty_contests |= dirty
+                self._joins[:0] = joins
+                self._links = {**links, **self._links}
+                self._users |= users
+                self._dirty_counters |= counter_names
+                return
+            if SHARED_STATE:
+                self._reconcile(contest_rows, written)
+
+    def _reconcile(self, contest_rows, written: Dict[str, str]) -> None:
+        """Принимает в память поля, которые запись взяла из базы (изменения других экземпляров)"""
+        for contest_id, local, _ in contest_rows:
+            data = written[contest_id]
+            if contest_id in contests and json.dumps(contests[contest_id], ensure_ascii=False) == local:
+                self._stored[contest_id] = data
+                if data != local:
+                    apply_contest_update(contest_id, json.loads(data))
+            elif contest_id in contests:
+                # Конкурс успел измениться во время записи: следующая запись перенесёт только эти
+                # изменения, а чужие поля из базы подтянутся после неё
+                self._stored[contest_id] = local
+
+    def secret(self, name: str) -> bytes:
+        """Секрет, созданный при первом запуске: одинаков после перезапусков и у всех экземпляров"""
+        self.conn.execute("INSERT OR IGNORE INTO meta (name, value) VALUES (?, ?)", (name, secrets.token_hex(32)))
+        return bytes.fromhex(self.conn.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()[0])
+
+    def _next_value(self, name: str) -> int:
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.conn.execute("INSERT OR IGNORE INTO sequences (name, value) VALUES (?, 0)", (name,))
+            self.conn.execute("UPDATE sequences SET value = value + 1 WHERE name = ?", (name,))
+            return self.conn.execute("SELECT value FROM sequences WHERE name = ?", (name,)).fetchone()[0] - 1
+
+    async def next_value(self, name: str) -> int:
+        """Следующее значение счётчика; атомарно и для нескольких процессов с одной базой"""
+        async with self._lock:
+            return await asyncio.to_thread(self._next_value, name)
+
+    # --- общий доступ нескольких экземпляров (SHARED_STATE) ---
+    def _insert_participant(self, row: Tuple[str, int, Optional[str], str]) -> bool:
+        cursor = self.conn.execute(
+            "INSERT OR IGNORE INTO participants (contest_id, user_id, username, name) VALUES (?, ?, ?, ?)", row
+        )
+        return cursor.rowcount == 1
+
+    async def join(self, contest_id: str, user_id: int, username: Optional[str], name: str) -> bool:
+        """Атомарная запись участника: при одновременных нажатиях на разных экземплярах пройдёт одно"""
+        async with self._lock:
+            return await asyncio.to_thread(self._insert_participant, (contest_id, user_id, username, name))
+
+    def _claim_finish(self, contest_id: str) -> bool:
+        cursor = self.conn.execute(
+            "UPDATE contests SET data = json_set(data, '$.is_active', json('false')), updated = ? "
+            "WHERE contest_id = ? AND json_extract(data, '$.is_active')",
+            (time.time(), contest_id)
+        )
+        return cursor.rowcount == 1
+
+    async def claim_finish(self, contest_id: str) -> bool:
+        """Захват завершения конкурса по таймеру: розыгрыш проводит только один экземпляр"""
+        async with self._lock:
+            return await asyncio.to_thread(self._claim_finish, contest_id)
+
+    def _read_changes(self, since: float, rowid: int) -> Tuple[List[Tuple], List[Tuple]]:
+        contest_rows = self.conn.execute(
+            "SELECT contest_id, data, updated FROM contests WHERE updated > ? ORDER BY updated", (since,)
+        ).fetchall()
+        joins = self.conn.execute(
+            "SELECT rowid, contest_id, user_id, username, name FROM participants WHERE rowid > ? ORDER BY rowid",
+            (rowid,)
+        ).fetchall()
+        return contest_rows, joins
+
+    async def sync(self) -> None:
+        """Подтягивает конкурсы и участников, записанных другими экземплярами"""
+        if not SHARED_STATE or self.conn is None:
+            return
+        async with self._lock:
+            contest_rows, joins = await asyncio.to_thread(
+                self._read_changes, self._synced_at - SHARED_SYNC_WINDOW, self._participant_rowid
+            )
+            for contest_id, data, updated in contest_rows:
+                self._synced_at = max(self._synced_at, updated)
+                # Несохранённые локальные изменения: строку из базы учтёт их запись (_merge)
+                if contest_id in self._dirty_contests:
+                    continue
+                self._stored[contest_id] = data
+                if contest_id in contests and json.dumps(contests[contest_id], ensure_ascii=False) == data:
+                    continue
+                apply_contest_update(contest_id, json.loads(data))
+            for rowid, contest_id, user_id, username, name in joins:
+                if participants.setdefault(contest_id, ParticipantRegistry()).add(user_id, username, name):
+                    bot_stats.participants += 1
+                self._participant_rowid = rowid
+
+    # --- архив завершённых конкурсов ---
+    def _archive(self, contest_id: str, row: Tuple) -> bool:
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            if SHARED_STATE:
+                # Без последней строки участников следующая получила бы уже прочитанный другими
+                # экземплярами rowid и потерялась бы в sync; такой конкурс уйдёт в архив позже
+                newest = self.conn.execute(
+                    "SELECT contest_id FROM participants ORDER BY rowid DESC LIMIT 1"
+                ).fetchone()
+                if newest and newest[0] == contest_id:
+                    return False
+            self.conn.execute(
+                "INSERT OR REPLACE INTO archive "
+                "(contest_id, creator_id, is_fast, channel_id, channel_username, participants, data) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)", row
+            )
+            self.conn.execute("DELETE FROM contests WHERE contest_id = ?", (contest_id,))
+            self.conn.execute("DELETE FROM participants WHERE contest_id = ?", (contest_id,))
+            self.conn.execute("DELETE FROM results_links WHERE contest_id = ?", (contest_id,))
+            return True
+
+    async def archive(self, contest_id: str) -> bool:
+        """Переносит завершённый конкурс из памяти в архив. False - если сейчас нельзя"""
+        async with self._lock:
+            contest = contests.get(contest_id)
+            if (
+                self.conn is None or contest is None or contest['is_active']
+                or contest_id in self._dirty_contests or contest_id in self._links
+            ):
+                return False
+            registry = participants.get(contest_id) or ParticipantRegistry()
+            data = json.dumps({
+                'contest': contest,
+                'participants': registry.columns(),
+                'results_link': results_links.get(contest_id),
+            }, ensure_ascii=False)
+            row = (
+                contest_id, contest['creator_id'], contest.get('is_fast', False),
+                contest['channel_id'], contest.get('channel_username'), len(registry)
+            )
+            archived = await asyncio.to_thread(
+                lambda: self._archive(contest_id, (*row, zlib.compress(data.encode(), 6)))
+            )
+            if archived:
+                archived_contests[contest_id] = ArchivedContest(*row[1:5])
+                del contests[contest_id]
+                self._stored.pop(contest_id, None)
+                participants.pop(contest_id, None)
+                results_links.pop(contest_id, None)
+                contest_last_used.pop(contest_id, None)
+                inline_cache.invalidate(contest_id)
+            return archived
+
+    def _unarchive(self, contest_id: str) -> Optional[Dict]:
+        row = self.conn.execute("SELECT data FROM archive WHERE contest_id = ?", (contest_id,)).fetchone()
+        if row is None:
+            return None
+        payload = json.loads(zlib.decompress(row[0]))
+        self.conn.execute(
+            "INSERT OR REPLACE INTO contests (contest_id, data, updated) VALUES (?, ?, ?)",
+            (contest_id, json.dumps(payload['contest'], ensure_ascii=False), time.time())
+        )
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO participants (contest_id, user_id, username, name) VALUES (?, ?, ?, ?)",
+            ((contest_id, *columns) for columns in zip(*payload['participants']))
+        )
+        if payload['results_link']:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO results_links (contest_id, url) VALUES (?, ?)",
+                (contest_id, payload['results_link'])
+            )
+        self.conn.execute("DELETE FROM archive WHERE contest_id = ?", (contest_id,))
+        return payload
+
+    def _restore(self, contest_id: str) -> Optional[Dict]:
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            return self._unarchive(contest_id)
+
+    async def restore(self, contest_id: str) -> bool:
+        """Возвращает конкурс из архива в память и рабочие таблицы"""
+        async with self._lock:
+            if contest_id in contests:
+                return True
+            if self.conn is None:
+                return False
+            payload = await asyncio.to_thread(self._restore, contest_id)
+            stub = archived_contests.pop(contest_id, None)
+            if payload is None:
+                # Конкурс уже вернул из архива другой экземпляр, его подтянет sync
+                if stub and contest_id in finished_by_creator.get(stub.creator_id, ()):
+                    del finished_by_creator[stub.creator_id][contest_id]
+                    if not finished_by_creator[stub.creator_id]:
+                        del finished_by_creator[stub.creator_id]
+                return False
+            contests[contest_id] = payload['contest']
+            if SHARED_STATE:
+                self._stored[contest_id] = json.dumps(payload['contest'], ensure_ascii=False)
+            participants[contest_id] = ParticipantRegistry.from_columns(*payload['participants'])
+            if payload['results_link']:
+                results_links[contest_id] = payload['results_link']
+            contest_last_used[contest_id] = time.time()
+            index_contest(contest_id)
+            return True
+
+    async def run(self) -> None:
+        """Фоновый сброс изменений на диск"""
+        while True:
+            await asyncio.sleep(DB_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+                await self.sync()
+            except Exception as e:
+                # Задача должна пережить любую ошибку, иначе до перезапуска ничего не сохранится
+                logging.error(f"Ошибка фонового сброса в базу: {e}")
+
+    async def close(self) -> None:
+        if self.conn is None:
+            return
+        await self.flush(save_stats=True)
+        self.conn.close()
+        self.conn = None
+
+# ===== ОЧЕРЕДЬ ИСХОДЯЩИХ СООБЩЕНИЙ =====
+PRIORITY_USER = 0  # ответы пользователям
+PRIORITY_ADMIN = 10  # уведомления админов
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity"""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated', 'blocked_until')
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Сколько секунд ждать до следующего токена"""
+        self._refill(now)
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1
+
+    def block(self, until: float) -> None:
+        self.blocked_until = max(self.blocked_until, until)
+
+    def is_idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity and now >= self.blocked_until
+
+class OutboundJob:
+    __slots__ = ('factory', 'chat_id', 'priority', 'future', 'attempts', 'not_before')
+
+    def __init__(self, factory: Callable[[], Awaitable[Any]], chat_id: Union[int, str], priority: int):
+        self.factory = factory
+        self.chat_id = chat_id
+        self.priority = priority
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.attempts = 0
+        self.not_before = 0.0
+
+class OutboundScheduler:
+    """Очередь отправок в Telegram с учётом лимитов.
+
+    Общий лимит бота и лимит на каждый чат - вёдра токенов. Задачи с меньшим
+    priority уходят раньше; задача, упёршаяся в лимит своего чата, не задерживает
+    остальные. На TelegramRetryAfter чат блокируется на указанное время и задача
+    повторяется, не больше SEND_MAX_RETRIES раз.
+
+    У каждого чата своя очередь, а в общих кучах лежат чаты, а не задачи: готовые к
+    отправке - по приоритету первой задачи, ждущие лимита - по времени готовности.
+    Поэтому задачи, упёршиеся в лимит чата, не перебираются при каждом пробуждении.
+    """
+
+    MAX_CHAT_BUCKETS = 10000
+
+    def __init__(self, global_rate: float, chat_rate: float, chat_burst: float):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats: Dict[Union[int, str], TokenBucket] = {}
+        self._queues: Dict[Union[int, str], List[Tuple[int, int, OutboundJob]]] = {}
+        # Записи куч: (ключ, seq, chat_id); актуальна только запись из _slots, остальные пропускаются
+        self._ready: List[Tuple[int, int, Union[int, str]]] = []
+        self._waiting: List[Tuple[float, int, Union[int, str]]] = []
+        self._slots: Dict[Union[int, str], Tuple] = {}
+        self._size = 0
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._sending: Set[asyncio.Task] = set()
+
+    def __len__(self) -> int:
+        return self._size
+
+    def _schedule(self, chat_id: Union[int, str], now: float) -> None:
+        """Кладёт чат в кучу готовых или ждущих по его первой задаче"""
+        queue = self._queues.get(chat_id)
+        if not queue:
+            self._slots.pop(chat_id, None)
+            return
+        priority, seq, job = queue[0]
+        delay = max(job.not_before - now, self._chat_bucket(chat_id, now).delay(now))
+        if delay <= 0:
+            entry = (priority, seq, chat_id)
+            heapq.heappush(self._ready, entry)
+        else:
+            entry = (now + delay, next(self._seq), chat_id)
+            heapq.heappush(self._waiting, entry)
+        self._slots[chat_id] = entry
+
+    def _push(self, job: OutboundJob) -> None:
+        queue = self._queues.setdefault(job.chat_id, [])
+        entry = (job.priority, next(self._seq), job)
+        heapq.heappush(queue, entry)
+        self._size += 1
+        if queue[0] is entry:
+            self._schedule(job.chat_id, time.monotonic())
+        self._wakeup.set()
+
+    def submit(
+        self,
+        factory: Callable[[], Awaitable[Any]],
+        chat_id: Union[int, str],
+        priority: int = PRIORITY_USER
+    ) -> asyncio.Future:
+        """Ставит вызов API в очередь. Результат можно дождаться через возвращённый future"""
+        job = OutboundJob(factory, chat_id, priority)
+        self._push(job)
+        return job.future
+
+    def enqueue(
+        self,
+        factory: Callable[[], Awaitable[Any]],
+        chat_id: Union[int, str],
+        priority: int = PRIORITY_USER
+    ) -> None:
+        """Как submit, но без ожидания: ошибка только пишется в лог"""
+        def _log_error(future: asyncio.Future):
+            if not future.cancelled() and future.exception() is not None:
+                logging.error(f"Ошибка отправки в чат {chat_id}: {future.exception()}")
+
+        self.submit(factory, chat_id, priority).add_done_callback(_log_error)
+
+    def _chat_bucket(self, chat_id: Union[int, str], now: float) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self.MAX_CHAT_BUCKETS:
+                self._chats = {cid: b for cid, b in self._chats.items() if not b.is_idle(now)}
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _next_ready(self) -> Tuple[Optional[OutboundJob], Optional[float]]:
+        """Самая приоритетная задача, которую можно отправить сейчас, либо время ожидания"""
+        now = time.monotonic()
+        while self._waiting and self._waiting[0][0] <= now:
+            entry = heapq.heappop(self._waiting)
+            if self._slots.get(entry[2]) is entry:
+                self._schedule(entry[2], now)
+        while self._ready and self._slots.get(self._ready[0][2]) is not self._ready[0]:
+            heapq.heappop(self._ready)
+        while self._waiting and self._slots.get(self._waiting[0][2]) is not self._waiting[0]:
+            heapq.heappop(self._waiting)
+
+        if not self._ready:
+            return None, (self._waiting[0][0] - now) if self._waiting else None
+        global_delay = self._global.delay(now)
+        if global_delay > 0:
+            return None, global_delay
+
+        chat_id = heapq.heappop(self._ready)[2]
+        del self._slots[chat_id]
+        queue = self._queues[chat_id]
+        job = heapq.heappop(queue)[2]
+        self._size -= 1
+        if not queue:
+            del self._queues[chat_id]
+        return job, None
+
+    async def run(self) -> None:
+        while True:
+            job, wait = self._next_ready()
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            now = time.monotonic()
+            self._global.consume(now)
+            self._chat_bucket(job.chat_id, now).consume(now)
+            # Следующая задача чата встаёт в очередь с учётом потраченного токена
+            self._schedule(job.chat_id, now)
+            task = asyncio.create_task(self._send(job))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    async def _send(self, job: OutboundJob) -> None:
+        job.attempts += 1
+        try:
+            result = await job.factory()
+        except TelegramRetryAfter as e:
+            if job.attempts > SEND_MAX_RETRIES:
+                if not job.future.done():
+                    job.future.set_exception(e)
+                return
+            logging.warning(f"Flood control в чате {job.chat_id}, повтор через {e.retry_after} с")
+            now = time.monotonic()
+            job.not_before = now + e.retry_after
+            # Ведро берётся на текущий момент: будущее время сдвинуло бы пополнение и вытеснение вёдер
+            self._chat_bucket(job.chat_id, now).block(job.not_before)
+            self._push(job)
+            # Блокировка касается всего чата, а не только повторяемой задачи
+            self._schedule(job.chat_id, now)
+        except Exception as e:
+            # Ожидавший обработчик мог быть отменён вместе со своим future
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            if not job.future.done():
+                job.future.set_result(result)
+
+    async def drain(self, timeout: float) -> None:
+        """Ждёт отправки очереди при остановке бота"""
+        deadline = time.monotonic() + timeout
+        while (self._size or self._sending) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+
+outbox = OutboundScheduler(SEND_GLOBAL_RATE, SEND_CHAT_RATE, SEND_CHAT_BURST)
+
+def send_later(chat_id: Union[int, str], text: str, priority: int = PRIORITY_USER, **kwargs) -> None:
+    """Отправка сообщения через очередь без ожидания"""
+    outbox.enqueue(lambda: bot.send_message(chat_id, text, **kwargs), chat_id, priority)
+
+def notify_admins(text: str) -> None:
+    for admin_id in ADMIN_IDS:
+        send_later(admin_id, text, priority=PRIORITY_ADMIN)
+
+# ===== ПРИЁМ ЗАЯВОК НА УЧАСТИЕ =====
+class JoinRequest:
+    __slots__ = ('call_id', 'contest_id', 'user', 'queued_at')
+
+    def __init__(self, call_id: str, contest_id: str, user: types.User):
+        self.call_id = call_id
+        self.contest_id = contest_id
+        self.user = user
+        self.queued_at = time.monotonic()
+
+class JoinPipeline:
+    """Очередь заявок на участие между обработчиком нажатия и проверкой подписок.
+
+    Обработчик только ставит заявку в ограниченную очередь и сразу освобождается;
+    JOIN_CONCURRENCY воркеров берут по одной заявке, так что медленная проверка
+    занимает только свой воркер. Ответ на нажатие отправляет воркер.
+    При полной очереди заявка не принимается.
+    """
+
+    def __init__(self, admit: Callable[[JoinRequest], Awaitable[None]]):
+        self._admit = admit
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=JOIN_QUEUE_SIZE)
+        self._pending: Set[Tuple[str, int]] = set()
+
+    def __len__(self) -> int:
+        return self._queue.qsize()
+
+    def is_pending(self, contest_id: str, user_id: int) -> bool:
+        return (contest_id, user_id) in self._pending
+
+    def submit(self, request: JoinRequest) -> bool:
+        """False - очередь переполнена, заявку нужно отклонить"""
+        try:
+            self._queue.put_nowait(request)
+        except asyncio.QueueFull:
+            return False
+        self._pending.add((request.contest_id, request.user.id))
+        return True
+
+    async def _process(self, request: JoinRequest) -> None:
+        name = self._admit.__name__
+        try:
+            await self._admit(request)
+        except Exception as e:
+            handler_errors.inc(name)
+            logging.error(f"Ошибка обработки заявки {request.user.id} в конкурс {request.contest_id}: {e}")
+        finally:
+            # Время от нажатия до ответа: ожидание в очереди плюс проверка подписок
+            handler_latency.observe(time.monotonic() - request.queued_at, name, 'callback_query')
+            self._pending.discard((request.contest_id, request.user.id))
+            self._queue.task_done()
+
+    async def _worker(self) -> None:
+        while True:
+            await self._process(await self._queue.get())
+
+    async def run(self) -> None:
+        await asyncio.gather(*(self._worker() for _ in range(JOIN_CONCURRENCY)))
+
+    async def drain(self, timeout: float) -> None:
+        """Даёт разобрать принятые заявки при остановке бота"""
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"Остановка с необработанными заявками на участие: {self._queue.qsize()}")
+
+# ===== ТАЙМЕРЫ КОНКУРСОВ =====
+class DeadlineScheduler:
+    """Дедлайны конкурсов: одна min-куча и одна фоновая задача на все конкурсы.
+
+    Дедлайны - unix-время, поэтому их можно восстановить из базы после перезапуска.
+    Отменённые и перенесённые дедлайны не удаляются из кучи, а пропускаются при извлечении.
+    """
+
+    def __init__(self, on_expire: Callable[[str], Awaitable[None]]):
+        self._on_expire = on_expire
+        self._heap: List[Tuple[float, str]] = []
+        self._deadlines: Dict[str, float] = {}
+        self._wakeup = asyncio.Event()
+        self._firing: Set[asyncio.Task] = set()
+
+    def __len__(self) -> int:
+        return len(self._deadlines)
+
+    def schedule(self, contest_id: str, deadline: float) -> None:
+        self._deadlines[contest_id] = deadline
+        heapq.heappush(self._heap, (deadline, contest_id))
+        if self._heap[0][1] == contest_id:
+            self._wakeup.set()
+
+    def cancel(self, contest_id: str) -> None:
+        self._deadlines.pop(contest_id, None)
+        if len(self._heap) > 2 * len(self._deadlines) + 1024:
+            self._heap = [(deadline, cid) for cid, deadline in self._deadlines.items()]
+            heapq.heapify(self._heap)
+
+    async def run(self) -> None:
+        while True:
+            while self._heap and self._deadlines.get(self._heap[0][1]) != self._heap[0][0]:
+                heapq.heappop(self._heap)
+            timeout = self._heap[0][0] - time.time() if self._heap else None
+            if timeout is None or timeout > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            _, contest_id = heapq.heappop(self._heap)
+            del self._deadlines[contest_id]
+            task = asyncio.create_task(self._fire(contest_id))
+            self._firing.add(task)
+            task.add_done_callback(self._firing.discard)
+
+    async def _fire(self, contest_id: str) -> None:
+        try:
+            await self._on_expire(contest_id)
+        except Exception as e:
+            logging.error(f"Ошибка при автозавершении конкурса {contest_id}: {e}")
+
+# ===== МЕТРИКИ =====
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _format_labels(names: Tuple[str, ...], values: Tuple) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(
+        f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+        for name, value in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, *label_values, amount: float = 1) -> None:
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def collect(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} counter"
+        for label_values, value in self._values.items():
+            yield f"{self.name}{_format_labels(self.labels, label_values)} {value}"
+
+class Histogram:
+    """Гистограмма с фиксированными границами; наблюдение - один bisect и два сложения"""
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = LATENCY_BUCKETS
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        # label_values -> [счётчики по корзинам (последняя - +Inf), сумма]
+        self._series: Dict[Tuple, List[float]] = {}
+
+    def observe(self, value: float, *label_values) -> None:
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [0] * (len(self.buckets) + 2)
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def collect(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} histogram"
+        names = self.labels + ("le",)
+        for label_values, series in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), series):
+                cumulative += count
+                le = "+Inf" if bound == float('inf') else repr(bound)
+                yield f"{self.name}_bucket{_format_labels(names, label_values + (le,))} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labels, label_values)} {series[-1]}"
+            yield f"{self.name}_count{_format_labels(self.labels, label_values)} {cumulative}"
+
+class CallbackMetric:
+    """Значения, которые вычисляются только в момент запроса /metrics"""
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        metric_type: str,
+        labels: Tuple[str, ...],
+        collect: Callable[[], Iterable[Tuple[Tuple, float]]]
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.metric_type = metric_type
+        self.labels = labels
+        self._collect = collect
+
+    def collect(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.metric_type}"
+        for label_values, value in self._collect():
+            yield f"{self.name}{_format_labels(self.labels, label_values)} {value}"
+
+metrics_registry: List[Any] = []
+
+def register_metric(metric):
+    metrics_registry.append(metric)
+    return metric
+
+def render_metrics() -> str:
+    return "\n".join(line for metric in metrics_registry for line in metric.collect()) + "\n"
+
+handler_latency = register_metric(Histogram(
+    'bot_handler_duration_seconds', 'Время работы обработчиков', ('handler', 'update_type')
+))
+handler_errors = register_metric(Counter(
+    'bot_handler_errors_total', 'Исключения в обработчиках', ('handler',)
+))
+api_requests = register_metric(Counter(
+    'bot_api_requests_total', 'Запросы к Bot API', ('method', 'status')
+))
+api_latency = register_metric(Histogram(
+    'bot_api_request_duration_seconds', 'Время запросов к Bot API', ('method',)
+))
+
+loop_lag = register_metric(Histogram(
+    'bot_event_loop_lag_seconds', 'Задержка цикла событий',
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+))
+slow_handlers_total = register_metric(Counter(
+    'bot_slow_handlers_total', 'Обработчики дольше SLOW_HANDLER_THRESHOLD', ('handler',)
+))
+
+class RollingCounter:
+    """События за последние size интервалов: кольцевой буфер, устаревшие ячейки обнуляются при записи"""
+
+    __slots__ = ('interval', '_counts', '_epochs')
+
+    def __init__(self, interval: float, size: int):
+        self.interval = interval
+        self._counts = [0] * size
+        self._epochs = [-1] * size
+
+    def add(self, amount: int = 1, now: Optional[float] = None) -> None:
+        epoch = int((time.time() if now is None else now) // self.interval)
+        slot = epoch % len(self._counts)
+        if self._epochs[slot] != epoch:
+            self._epochs[slot] = epoch
+            self._counts[slot] = 0
+        self._counts[slot] += amount
+
+    def series(self, now: Optional[float] = None) -> List[int]:
+        """Значения по интервалам, от самого старого до текущего"""
+        epoch = int((time.time() if now is None else now) // self.interval)
+        size = len(self._counts)
+        return [
+            self._counts[e % size] if self._epochs[e % size] == e else 0
+            for e in range(epoch - size + 1, epoch + 1)
+        ]
+
+    def state(self) -> List[List[int]]:
+        return [self._counts, self._epochs]
+
+    def load_state(self, state: List[List[int]]) -> None:
+        counts, epochs = state
+        if len(counts) == len(self._counts):
+            # Ячейки старше окна отбрасываются по epoch при чтении
+            self._counts, self._epochs = list(counts), list(epochs)
+
+class Trend:
+    """Итог с момента запуска плюс ряды по минутам за час и по часам за сутки"""
+
+    __slots__ = ('total', 'minutes', 'hours')
+
+    def __init__(self):
+        self.total = 0
+        self.minutes = RollingCounter(60, 60)
+        self.hours = RollingCounter(3600, 24)
+
+    def add(self, amount: int = 1) -> None:
+        now = time.time()
+        self.total += amount
+        self.minutes.add(amount, now)
+        self.hours.add(amount, now)
+
+    def last_hour(self) -> int:
+        return sum(self.minutes.series())
+
+    def last_day(self) -> int:
+        return sum(self.hours.series())
+
+    def state(self) -> Dict:
+        """Ряды для сохранения в базе; итог с момента запуска не сохраняется"""
+        return {'minutes': self.minutes.state(), 'hours': self.hours.state()}
+
+    def load_state(self, state: Dict) -> None:
+        self.minutes.load_state(state['minutes'])
+        self.hours.load_state(state['hours'])
+
+JOIN_REJECTIONS = {
+    'not_found': "конкурс не найден или завершён",
+    'already_joined': "уже участвует",
+    'not_subscribed': "нет подписки",
+    'check_failed': "подписку не удалось проверить",
+    'overloaded': "перегрузка, просили повторить",
+}
+
+class BotStats:
+    """Счётчики для статистики админа: обновляются по событию, чтение не обходит конкурсы"""
+
+    def __init__(self):
+        self.participants = 0
+        self.contests_created = Trend()
+        self.joins = Trend()
+        self.join_rejections: Dict[str, Trend] = {reason: Trend() for reason in JOIN_REJECTIONS}
+
+    def reject_join(self, reason: str) -> None:
+        self.join_rejections[reason].add()
+
+    def _trends(self) -> Dict[str, Trend]:
+        return {
+            'contests_created': self.contests_created,
+            'joins': self.joins,
+            **{f"join_rejections:{reason}": trend for reason, trend in self.join_rejections.items()}
+        }
+
+    def state(self) -> str:
+        """Ряды за час и сутки: переживают перезапуск и засыпание бота"""
+        return json.dumps({name: trend.state() for name, trend in self._trends().items()})
+
+    def load_state(self, data: str) -> None:
+        saved = json.loads(data)
+        for name, trend in self._trends().items():
+            if name in saved:
+                trend.load_state(saved[name])
+
+bot_stats = BotStats()
+
+register_metric(CallbackMetric(
+    'bot_contests_created_total', 'Опубликованные конкурсы с момента запуска', 'counter', (),
+    lambda: [((), bot_stats.contests_created.total)]
+))
+register_metric(CallbackMetric(
+    'bot_joins_total', 'Успешные вступления в конкурсы с момента запуска', 'counter', (),
+    lambda: [((), bot_stats.joins.total)]
+))
+register_metric(CallbackMetric(
+    'bot_join_rejections_total', 'Отказы во вступлении по причинам', 'counter', ('reason',),
+    lambda: [((reason,), trend.total) for reason, trend in bot_stats.join_rejections.items()]
+))
+
+# ===== ДИАГНОСТИКА =====
+def _coroutine_stack(task: asyncio.Task) -> List[str]:
+    """Стек ожидающей корутины по цепочке cr_await (Task.get_stack даёт только верхний кадр)"""
+    frames = []
+    coro = task.get_coro()
+    while coro is not None:
+        frame = getattr(coro, 'cr_frame', None) or getattr(coro, 'gi_frame', None)
+        if frame is None:
+            break
+        frames.append(frame)
+        coro = getattr(coro, 'cr_await', None) or getattr(coro, 'gi_yieldfrom', None)
+    return traceback.format_list(traceback.StackSummary.extract((f, f.f_lineno) for f in frames))
+
+class LoopMonitor:
+    """Замер задержки цикла событий и поиск блокировок.
+
+    Задача в цикле просыпается каждые LOOP_LAG_INTERVAL и записывает опоздание.
+    Сторожевой поток замечает, что задача давно не просыпалась, и снимает стек
+    потока цикла - так видно, какой синхронный код его заблокировал.
+    """
+
+    def __init__(self):
+        self.samples: deque = deque(maxlen=600)  # (время, задержка)
+        self.stalls: deque = deque(maxlen=50)
+        self.slow_handlers: deque = deque(maxlen=100)
+        self.loop_thread_id: Optional[int] = None
+        self._heartbeat = time.monotonic()
+        self._stop = threading.Event()
+        self._profile_lock = threading.Lock()
+
+    async def run(self) -> None:
+        self.loop_thread_id = threading.get_ident()
+        watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        watchdog.start()
+        try:
+            while True:
+                expected = time.monotonic() + LOOP_LAG_INTERVAL
+                await asyncio.sleep(LOOP_LAG_INTERVAL)
+                now = time.monotonic()
+                self._heartbeat = now
+                lag = max(now - expected, 0.0)
+                self.samples.append((time.time(), lag))
+                loop_lag.observe(lag)
+        finally:
+            self._stop.set()
+
+    def _watch(self) -> None:
+        reported_heartbeat = None
+        while not self._stop.wait(LOOP_STALL_THRESHOLD / 2):
+            heartbeat = self._heartbeat
+            stalled = time.monotonic() - heartbeat - LOOP_LAG_INTERVAL
+            if stalled < LOOP_STALL_THRESHOLD or heartbeat == reported_heartbeat:
+                continue
+            reported_heartbeat = heartbeat
+            frame = sys._current_frames().get(self.loop_thread_id)
+            stack = traceback.format_stack(frame) if frame else []
+            self.stalls.append({'time': time.time(), 'stalled_for': round(stalled, 3), 'stack': stack})
+            logging.warning(f"🐢 Цикл событий заблокирован на {stalled:.2f} с:\n{''.join(stack[-5:])}")
+
+    def record_slow_handler(self, name: str, update_type: str, duration: float, stack: List[str]) -> None:
+        slow_handlers_total.inc(name)
+        self.slow_handlers.append({
+            'time': time.time(),
+            'handler': name,
+            'update_type': update_type,
+            'duration': round(duration, 3),
+            'stack': stack
+        })
+
+    def summary(self) -> Dict:
+        lags = sorted(lag for _, lag in self.samples)
+        summary = {'samples': len(lags), 'stalls': list(self.stalls)}
+        if lags:
+            summary.update(
+                lag_last=self.samples[-1][1],
+                lag_p50=lags[len(lags) // 2],
+                lag_p99=lags[min(len(lags) - 1, int(len(lags) * 0.99))],
+                lag_max=lags[-1]
+            )
+        return summary
+
+    def profile(self, seconds: float, interval: float = 0.005) -> str:
+        """Семплирующий профиль потока цикла событий в формате collapsed stacks (flamegraph)"""
+        if not self._profile_lock.acquire(blocking=False):
+            raise RuntimeError("Профилирование уже идёт")
+        try:
+            stacks = TallyCounter()
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                frame = sys._current_frames().get(self.loop_thread_id)
+                if frame is not None:
+                    names = []
+                    while frame is not None:
+                        code = frame.f_code
+                        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                        frame = frame.f_back
+                    stacks[";".join(reversed(names))] += 1
+                time.sleep(interval)
+            return "\n".join(f"{stack} {count}" for stack, count in stacks.most_common()) + "\n"
+        finally:
+            self._profile_lock.release()
+
+loop_monitor = LoopMonitor()
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Время работы каждого обработчика по его имени и запись медленных обработчиков"""
+
+    def __init__(self, update_type: str):
+        self.update_type = update_type
+
+    async def __call__(self, handler, event, data):
+        if isinstance(event, CallbackQuery):
+            name = callback_router.handler_name(event.data)
+        else:
+            name = data['handler'].callback.__name__ if 'handler' in data else 'unknown'
+        task = asyncio.current_task()
+        stack: List[str] = []
+        # Стек снимается в момент превышения порога - там, где обработчик ждёт
+        timer = asyncio.get_running_loop().call_later(
+            SLOW_HANDLER_THRESHOLD, lambda: stack.extend(_coroutine_stack(task))
+        )
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            handler_errors.inc(name)
+            raise
+        finally:
+            timer.cancel()
+            duration = time.perf_counter() - started
+            handler_latency.observe(duration, name, self.update_type)
+            if duration >= SLOW_HANDLER_THRESHOLD:
+                loop_monitor.record_slow_handler(name, self.update_type, duration, stack)
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    """Число и время запросов к Bot API по методам"""
+
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        started = time.perf_counter()
+        status = 'ok'
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter:
+            status = 'retry_after'
+            raise
+        except Exception:
+            status = 'error'
+            raise
+        finally:
+            api_requests.inc(name, status)
+            api_latency.observe(time.perf_counter() - started, name)
+
+for _update_type in ('message', 'callback_query', 'inline_query'):
+    dp.observers[_update_type].middleware(HandlerMetricsMiddleware(_update_type))
+bot.session.middleware(ApiMetricsMiddleware())
+
 # ===== ГЛОБАЛЬНЫЕ ПЕРЕМЕННЫЕ =====
 contests: Dict[str, Dict] = {}
-participants: Dict[str, List[Dict]] = {}
+participants: Dict[str, ParticipantRegistry] = {}
 results_links: Dict[str, str] = {}
-unique_users: Set[int] = set()
+archived_contests: Dict[str, ArchivedContest] = {}
+contest_last_used: Dict[str, float] = {}  # завершённые конкурсы в памяти -> время последнего обращения
+unique_users = UniqueUsers()
+storage = Storage(DB_PATH)
+
+# Индексы конкурсов по создателю; dict используется как упорядоченное множество
+active_by_creator: Dict[int, Dict[str, None]] = {}
+finished_by_creator: Dict[int, Dict[str, None]] = {}
 
 # ===== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ =====
 def is_admin(user_id: int) -> bool:
     return user_id in ADMIN_IDS
 
-def generate_contest_id(is_fast: bool = False) -> str:
-    while True:
-        contest_id = f"F{random.randint(100000, 999999)}" if is_fast else str(random.randint(100000, 999999))
+def index_contest(contest_id: str) -> None:
+    """Кладёт конкурс в индекс активных или завершённых конкурсов его создателя"""
+    contest = contests[contest_id]
+    creator_id = contest['creator_id']
+    if contest['is_active']:
+        target, other = active_by_creator, finished_by_creator
+    else:
+        target, other = finished_by_creator, active_by_creator
+    if creator_id in other:
+        other[creator_id].pop(contest_id, None)
+        if not other[creator_id]:
+            del other[creator_id]
+    target.setdefault(creator_id, {})[contest_id] = None
+
+def render_inline_result(contest_id: str) -> InlineQueryResultArticle:
+    """Карточка конкурса для inline-режима"""
+    contest = contests[contest_id]
+    kb = InlineKeyboardBuilder()
+    if contest['is_active']:
+        kb.button(text="🎁 Участвовать", callback_data=JoinCallback(contest_id=contest_id))
+    kb.adjust(1)
+    return InlineQueryResultArticle(
+        # id меняется вместе с состоянием, чтобы клиенты не показывали устаревшую карточку
+        id=f"{contest_id}:{'active' if contest['is_active'] else 'finished'}",
+        title=f"{'ФАСТ Конкурс' if contest.get('is_fast', False) else 'Конкурс'} в @{contest['channel_username']} (ID: {contest_id})",
+        input_message_content=InputTextMessageContent(
+            message_text=contest['conditions']
+        ),
+        description=contest['conditions'][:100] + ("..." if len(contest['conditions']) > 100 else ""),
+        reply_markup=kb.as_markup() if contest['is_active'] else None
+    )
+
+def refresh_inline_result(contest_id: str) -> None:
+    """Пересобирает закэшированную карточку после изменения конкурса"""
+    inline_cache.invalidate(contest_id)
+    if contests[contest_id].get('channel_username'):
+        inline_cache.set(contest_id, render_inline_result(contest_id))
+
+def channel_username_stale(contest: Dict) -> bool:
+    """Username канала не запрашивался дольше CHAT_CACHE_TTL: канал мог быть переименован"""
+    return (
+        'channel_username' not in contest
+        or time.time() - contest.get('channel_username_at', 0) >= CHAT_CACHE_TTL
+    )
+
+async def fill_channel_username(contest_id: str) -> bool:
+    """Дозапрашивает или обновляет устаревший username канала. True - если username изменился"""
+    contest = contests[contest_id]
+    if not channel_username_stale(contest):
+        return False
+    had_username = 'channel_username' in contest
+    # Отметка ставится до запроса: параллельные вызовы и недоступный канал не дёргают API повторно
+    contest['channel_username_at'] = time.time()
+    chat = await get_chat_cached(contest['channel_id'])
+    if had_username and contest['channel_username'] == chat.username:
+        return False
+    contest['channel_username'] = chat.username
+    storage.save_contest(contest_id)
+    return True
+
+channel_username_tasks: Set[asyncio.Task] = set()
+
+def fill_channel_usernames_later(contest_ids: Iterable[str]) -> None:
+    """Фоновое заполнение и обновление username каналов: меню открывается без запросов к API"""
+    stale = [cid for cid in contest_ids if cid in contests and channel_username_stale(contests[cid])]
+    if not stale:
+        return
+
+    async def fill():
+        for contest_id in stale:
+            try:
+                if await fill_channel_username(contest_id):
+                    refresh_inline_result(contest_id)
+            except Exception as e:
+                logging.error(f"Не удалось получить канал конкурса {contest_id}: {e}")
+
+    task = asyncio.create_task(fill())
+    channel_username_tasks.add(task)
+    task.add_done_callback(channel_username_tasks.discard)
+
+async def get_inline_result(contest_id: str) -> InlineQueryResultArticle:
+    async def load() -> InlineQueryResultArticle:
+        await fill_channel_username(contest_id)
+        return render_inline_result(contest_id)
+
+    result = await inline_cache.get_or_load(contest_id, load)
+    # Карточка в кэше бессрочная: переименование канала подхватывается в фоне
+    fill_channel_usernames_later((contest_id,))
+    return result
+
+def register_contest(contest_id: str, contest: Dict) -> None:
+    """Регистрирует опубликованный конкурс"""
+    contests[contest_id] = contest
+    participants[contest_id] = ParticipantRegistry()
+    index_contest(contest_id)
+    storage.save_contest(contest_id)
+    refresh_inline_result(contest_id)
+    bot_stats.contests_created.add()
+
+def apply_contest_update(contest_id: str, contest: Dict) -> None:
+    """Применяет версию конкурса, записанную другим экземпляром бота"""
+    contests[contest_id] = contest
+    participants.setdefault(contest_id, ParticipantRegistry())
+    archived_contests.pop(contest_id, None)
+    index_contest(contest_id)
+    refresh_inline_result(contest_id)
+    if contest['is_active'] and contest.get('ends_at'):
+        deadlines.schedule(contest_id, contest['ends_at'])
+    else:
+        deadlines.cancel(contest_id)
+        contest_last_used.setdefault(contest_id, time.time())
+
+async def get_contest(contest_id: str, fresh: bool = False) -> Optional[Dict]:
+    """Конкурс по ID; в режиме SHARED_STATE при промахе сначала подтягиваются изменения из базы.
+
+    fresh=True - перед розыгрышем, чтобы учесть участников, записанных другими экземплярами.
+    Конкурс из архива возвращается в память при первом обращении.
+    """
+    if fresh or contest_id not in contests:
+        await storage.sync()
+    if contest_id not in contests and contest_id in archived_contests:
+        if not await storage.restore(contest_id):
+            await storage.sync()
+    contest = contests.get(contest_id)
+    if contest is not None and not contest['is_active']:
+        contest_last_used[contest_id] = time.time()
+    return contest
+
+async def add_participant(contest_id: str, user: types.User) -> bool:
+    """Регистрирует участника, False - если он уже участвует"""
+    username = user.username or None
+    if SHARED_STATE:
+        # Уникальность проверяет база, локальный реестр мог ещё не увидеть участие через другой экземпляр
+        if not await storage.join(contest_id, user.id, username, user.full_name):
+            return False
+        if participants.setdefault(contest_id, ParticipantRegistry()).add(user.id, username, user.full_name):
+            bot_stats.participants += 1
+    else:
+        if not participants.setdefault(contest_id, ParticipantRegistry()).add(user.id, username, user.full_name):
+            return False
+        storage.add_participant(contest_id, user.id, username, user.full_name)
+        bot_stats.participants += 1
+    bot_stats.joins.add()
+    return True
+
+def finish_contest(contest_id: str) -> None:
+    """Помечает конкурс завершённым"""
+    contests[contest_id]['is_active'] = False
+    contests[contest_id]['finished_at'] = contest_last_used[contest_id] = time.time()
+    index_contest(contest_id)
+    storage.save_contest(contest_id)
+    deadlines.cancel(contest_id)
+    refresh_inline_result(contest_id)
+
+async def archive_idle_contests() -> int:
+    """Выгружает в архив завершённые конкурсы, к которым не обращались дольше ARCHIVE_AFTER"""
+    cutoff = time.time() - ARCHIVE_AFTER
+    idle = [cid for cid, used in contest_last_used.items() if used <= cutoff]
+    if not idle:
+        return 0
+    await storage.flush()
+    archived = 0
+    for contest_id in idle:
         if contest_id not in contests:
+            contest_last_used.pop(contest_id, None)
+        elif contest_last_used.get(contest_id, 0) <= cutoff and await storage.archive(contest_id):
+            archived += 1
+    if archived:
+        logging.info(f"🗄 В архив выгружено конкурсов: {archived}")
+    return archived
+
+async def run_archiver() -> None:
+    while True:
+        await asyncio.sleep(ARCHIVE_CHECK_INTERVAL)
+        try:
+            await archive_idle_contests()
+        except Exception as e:
+            logging.error(f"Ошибка выгрузки конкурсов в архив: {e}")
+
+def format_results_text(contest: Dict, winners_text: str) -> str:
+    """Текст поста конкурса после подведения итогов"""
+    if contest.get('is_fast', False):
+        return f"{contest['conditions']}\n\n{winners_text}"
+    return (
+        f"🎉КОНКУРС🎉\n\n"
+        f"Условия: {contest['conditions']}\n\n"
+        f"Подписаться на: {', '.join(f'@{ch}' for ch in contest['channels'])}\n\n"
+        f"Победителей: {contest['winner_count']}\n\n"
+        + (f"{format_draw_commitment(contest['draw_seed'])}\n\n" if contest.get('draw_seed') else "")
+        + winners_text
+    )
+
+def format_winners(winners: List[Dict]) -> str:
+    return ", ".join(f"@{w['username']}" if w['username'] else w['name'] for w in winners)
+
+def draw_winners(contest_id: str, k: int, keep: List[Dict] = ()) -> Tuple[List[Dict], Dict]:
+    """Случайный выбор k новых победителей, не совпадающих с победителями из keep.
+
+    Seed заявлен хэшем в посте конкурса, номер раунда растёт только с публикацией итогов.
+    Возвращает победителей и запись о розыгрыше для публикации: seed, раунд, число
+    участников и хэш их порядка.
+    """
+    contest = contests[contest_id]
+    if not contest.get('draw_seed'):
+        # Конкурс опубликован до появления хэша seed: фиксируем seed хотя бы сейчас
+        contest['draw_seed'] = new_draw_seed().hex()
+        storage.save_contest(contest_id)
+    registry = participants.get(contest_id) or ParticipantRegistry()
+    exclude = set()
+    for winner in keep:
+        participant = (
+            registry.get(winner['user_id']) if winner.get('user_id') is not None
+            else registry.get_by_username(winner['username']) if winner.get('username')
+            else None
+        )
+        if participant:
+            exclude.add(registry.index_of(participant['user_id']))
+
+    round_number = contest.get('draw_rounds', 0)
+    indices = draw_indices(round_seed(bytes.fromhex(contest['draw_seed']), round_number), len(registry), k, exclude)
+    draw = {
+        'seed': contest['draw_seed'],
+        'round': round_number,
+        'population': len(registry),
+        'excluded': len(exclude),
+        'participants': registry.digest(),
+    }
+    return [dict(registry[i]) for i in indices], draw
+
+async def resolve_winners(contest_id: str, inputs: List[str]) -> Tuple[List[Dict], List[Dict]]:
+    """Победители по введённым id и username.
+
+    Сначала ищем среди участников конкурса; только неизвестные числовые id запрашиваются
+    у Telegram, параллельно и не больше WINNER_LOOKUP_CONCURRENCY одновременно.
+    Возвращает победителей в порядке ввода и тех из них, кто не участвовал в конкурсе.
+    """
+    registry = participants.get(contest_id) or ParticipantRegistry()
+    winners: List[Optional[Dict]] = [None] * len(inputs)
+    lookups: Dict[int, int] = {}
+    for i, raw in enumerate(inputs):
+        value = raw.lstrip('@')
+        participant = registry.get(int(value)) if value.isdigit() else registry.get_by_username(value)
+        if participant:
+            winners[i] = dict(participant)
+        elif value.isdigit():
+            lookups[i] = int(value)
+        else:
+            winners[i] = {'user_id': None, 'username': value, 'name': value}
+
+    semaphore = asyncio.Semaphore(WINNER_LOOKUP_CONCURRENCY)
+
+    async def lookup(i: int, user_id: int):
+        async with semaphore:
+            try:
+                user = await get_chat_cached(user_id)
+                winners[i] = {'user_id': user_id, 'username': user.username or None, 'name': user.full_name}
+            except Exception:
+                winners[i] = {'user_id': user_id, 'username': None, 'name': f"User {user_id}"}
+
+    await asyncio.gather(*(lookup(i, user_id) for i, user_id in lookups.items()))
+    outsiders = [w for w in winners if w['user_id'] is None or w['user_id'] not in registry]
+    return winners, outsiders
+
+def format_participant(position: int, participant: Dict) -> str:
+    # Имя обрезается, чтобы страница гарантированно влезла в одно сообщение
+    label = f"@{participant['username']}" if participant['username'] else participant['name'][:48]
+    return f"{position + 1}. {label} ({participant['user_id']})"
+
+def render_participants_page(contest_id: str, page: int) -> Tuple[str, InlineKeyboardMarkup]:
+    """Страница списка участников с кнопками навигации и выгрузки в CSV"""
+    registry = participants.get(contest_id) or ParticipantRegistry()
+    pages = max(1, -(-len(registry) // PARTICIPANTS_PAGE_SIZE))
+    page = min(page, pages - 1)
+    start = page * PARTICIPANTS_PAGE_SIZE
+    lines = [format_participant(start + i, u) for i, u in enumerate(registry.page(start, start + PARTICIPANTS_PAGE_SIZE))]
+    text = f"📋 Участники конкурса {contest_id} (всего {len(registry)}):\n\n" + ("\n".join(lines) or "😢 Нет участников.")
+
+    kb = InlineKeyboardBuilder()
+    nav = 0
+    if page > 0:
+        kb.button(text="◀️", callback_data=ParticipantsPageCallback(contest_id=contest_id, page=page - 1))
+        nav += 1
+    if pages > 1:
+        kb.button(text=f"{page + 1}/{pages}", callback_data=ParticipantsPageCallback(contest_id=contest_id, page=page))
+        nav += 1
+    if page < pages - 1:
+        kb.button(text="▶️", callback_data=ParticipantsPageCallback(contest_id=contest_id, page=page + 1))
+        nav += 1
+    kb.button(text="📄 Выгрузить CSV", callback_data=ParticipantsExportCallback(contest_id=contest_id))
+    kb.adjust(*([nav] if nav else []), 1)
+    return text, kb.as_markup()
+
+class ParticipantsCSV(InputFile):
+    """CSV со всеми участниками, который формируется кусками прямо во время загрузки в Telegram.
+
+    В памяти одновременно только один кусок, размер конкурса на неё не влияет.
+    """
+
+    def __init__(self, contest_id: str):
+        super().__init__(filename=f"participants_{contest_id}.csv")
+        self.contest_id = contest_id
+
+    async def read(self, bot: Bot) -> AsyncIterator[bytes]:
+        registry = participants.get(self.contest_id) or ParticipantRegistry()
+        total = len(registry)  # снимок: вступившие во время выгрузки в файл не попадут
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(['position', 'user_id', 'username', 'name'])
+        for start in range(0, total, 1000):
+            for i, u in enumerate(registry.page(start, min(start + 1000, total))):
+                writer.writerow([start + i + 1, u['user_id'], u['username'] or '', u['name']])
+                if buffer.tell() >= self.chunk_size:
+                    yield buffer.getvalue().encode('utf-8')
+                    buffer.seek(0)
+                    buffer.truncate()
+        yield buffer.getvalue().encode('utf-8')
+
+def format_draws(draws: List[Dict]) -> str:
+    """Данные для проверки розыгрыша"""
+    return "\n".join(
+        f"🎲 Seed: {d['seed']} (раунд {d.get('round', 0)}, участников: {d['population']}"
+        + (f", места: {', '.join(map(str, d['slots']))}" if d.get('slots') else "")
+        + ")"
+        + (f"\n   SHA-256 порядка участников: {d['participants']}" if d.get('participants') else "")
+        for d in draws
+    )
+
+async def auto_finish_contest(contest_id: str) -> None:
+    """Завершение конкурса по таймеру: розыгрыш и публикация итогов в посте"""
+    contest = await get_contest(contest_id, fresh=True)
+    if not contest or not contest['is_active']:
+        return
+    if SHARED_STATE and not await storage.claim_finish(contest_id):
+        return  # конкурс уже завершил другой экземпляр
+
+    winners, draw = draw_winners(contest_id, contest['winner_count'])
+    contest['winners'] = winners
+    contest['draws'] = [draw]
+    contest['draw_rounds'] = draw['round'] + 1
+    winners_text = (
+        "🏆 Победители конкурса: " + format_winners(winners) + "\n\n" + format_draws([draw]) if winners
+        else "😢 Конкурс завершён без участников."
+    )
+    finish_contest(contest_id)
+
+    try:
+        await outbox.submit(
+            lambda: bot.edit_message_text(
+                chat_id=contest['channel_id'],
+                message_id=contest['message_id'],
+                text=format_results_text(contest, winners_text)
+            ),
+            contest['channel_id']
+        )
+    except Exception as e:
+        logging.error(f"Ошибка при публикации итогов конкурса {contest_id}: {e}")
+    send_later(contest['creator_id'], f"⏰ Конкурс {contest_id} завершён по времени.\n\n{winners_text}")
+
+def schedule_deadlines() -> None:
+    """Восстанавливает таймеры активных конкурсов после перезапуска"""
+    for contest_id, contest in contests.items():
+        if contest['is_active'] and contest.get('ends_at'):
+            deadlines.schedule(contest_id, contest['ends_at'])
+
+deadlines = DeadlineScheduler(auto_finish_contest)
+
+async def generate_contest_id(is_fast: bool = False) -> str:
+    while True:
+        number = await storage.next_value('contest_id:fast' if is_fast else 'contest_id:regular')
+        contest_id = contest_ids.format(number, is_fast)
+        # Совпасть можно только с ID, выданным прежним случайным генератором
+        if contest_id not in archived_contests and await get_contest(contest_id) is None:
             return contest_id
 
+SPARK_BARS = "▁▂▃▄▅▆▇█"
+
+def sparkline(values: List[int]) -> str:
+    peak = max(values)
+    if not peak:
+        return SPARK_BARS[0] * len(values)
+    return "".join(SPARK_BARS[(v * (len(SPARK_BARS) - 1) + peak - 1) // peak] for v in values)
+
 def get_statistics() -> str:
-    total_contests = len(contests)
-    total_participants = sum(len(participants.get(cid, [])) for cid in contests)
-    total_users = len(unique_users)
+    chat_stats = chat_cache.stats()
+    member_stats = member_cache.stats()
+    rejections = "\n".join(
+        f"  {JOIN_REJECTIONS[reason]}: {trend.last_hour()} / {trend.last_day()}"
+        for reason, trend in bot_stats.join_rejections.items()
+    )
     return (
         f"📊 Статистика бота:\n"
-        f"Всего конкурсов: {total_contests}\n"
-        f"Всего участников: {total_participants}\n"
-        f"Уникальных пользователей: {total_users}"
+        f"Всего конкурсов: {len(contests) + len(archived_contests)} (в архиве: {len(archived_contests)})\n"
+        f"Всего участников: {bot_stats.participants}\n"
+        f"Уникальных пользователей: {'≈' if unique_users.total.approximate else ''}{unique_users.count()} "
+        f"(сегодня: {unique_users.count_days(1)}, за {UNIQUE_USERS_DAYS} дн.: {unique_users.count_days(UNIQUE_USERS_DAYS)})\n\n"
+        f"За час / за сутки:\n"
+        f"Новых конкурсов: {bot_stats.contests_created.last_hour()} / {bot_stats.contests_created.last_day()}\n"
+        f"Вступлений: {bot_stats.joins.last_hour()} / {bot_stats.joins.last_day()}\n"
+        f"Отказов во вступлении:\n{rejections}\n"
+        f"Вступления по часам за сутки:\n{sparkline(bot_stats.joins.hours.series())}\n\n"
+        f"Кэш каналов: {chat_stats['hits']} попаданий / {chat_stats['misses']} промахов "
+        f"({chat_stats['coalesced']} объединено)\n"
+        f"Кэш подписок: {member_stats['hits']} попаданий / {member_stats['misses']} промахов "
+        f"({member_stats['coalesced']} объединено)"
     )
 
 # ===== ОБРАБОТЧИКИ КОМАНД =====
@@ -94,20 +2483,16 @@ async def cmd_start(message: Message):
     user_id = message.from_user.id
     kb = InlineKeyboardBuilder()
     
-    kb.button(text="🎉 Создать конкурс", callback_data="new_contest")
+    kb.button(text="🎉 Создать конкурс", callback_data=NewContestCallback())
     
-    active_contests = [cid for cid, c in contests.items() 
-                      if c['is_active'] and c['creator_id'] == user_id]
-    if active_contests:
-        kb.button(text="🏆 Подвести итоги", callback_data="pick_winners")
+    if active_by_creator.get(user_id):
+        kb.button(text="🏆 Подвести итоги", callback_data=PickMenuCallback())
     
-    finished_contests = [cid for cid, c in contests.items() 
-                        if not c['is_active'] and c['creator_id'] == user_id]
-    if finished_contests:
-        kb.button(text="🔄 Рерол победителей", callback_data="reroll_winners")
+    if finished_by_creator.get(user_id):
+        kb.button(text="🔄 Рерол победителей", callback_data=RerollMenuCallback())
     
     if is_admin(user_id):
-        kb.button(text="📊 Статистика", callback_data="stats")
+        kb.button(text="📊 Статистика", callback_data=StatsCallback())
     
     kb.adjust(1)
     
@@ -117,8 +2502,8 @@ async def cmd_start(message: Message):
         reply_markup=kb.as_markup()
     )
 
-@dp.callback_query(lambda c: c.data == "new_contest")
-async def new_contest(call: CallbackQuery, state: FSMContext):
+@callback_router.route(NewContestCallback)
+async def new_contest(call: CallbackQuery, callback_data: NewContestCallback, state: FSMContext):
     if call.message.chat.type != "private":
         await call.message.answer("❌ Создавайте конкурсы в личных сообщениях с ботом")
         return
@@ -169,8 +2554,8 @@ async def winners_received(message: Message, state: FSMContext):
 
     data = await state.get_data()
     kb = InlineKeyboardBuilder()
-    kb.button(text="✅ Подтвердить", callback_data=f"confirm:{count}")
-    kb.button(text="❌ Отменить", callback_data="cancel")
+    kb.button(text="✅ Подтвердить", callback_data=ConfirmCallback(winner_count=count))
+    kb.button(text="❌ Отменить", callback_data=CancelCallback())
     kb.adjust(1)
 
     await message.answer(
@@ -183,16 +2568,16 @@ async def winners_received(message: Message, state: FSMContext):
     )
     await state.update_data(winner_count=count)
 
-@dp.callback_query(lambda c: c.data.startswith("confirm"))
-async def confirm_callback(call: CallbackQuery, state: FSMContext):
+@callback_router.route(ConfirmCallback)
+async def confirm_callback(call: CallbackQuery, callback_data: ConfirmCallback, state: FSMContext):
     await call.message.edit_reply_markup()
     await call.message.answer(
         "📢 Укажите username канала для публикации (например @my_channel)"
     )
     await state.set_state(ContestStates.waiting_for_target_channel)
 
-@dp.callback_query(lambda c: c.data == "cancel")
-async def cancel_callback(call: CallbackQuery, state: FSMContext):
+@callback_router.route(CancelCallback)
+async def cancel_callback(call: CallbackQuery, callback_data: CancelCallback, state: FSMContext):
     await call.message.edit_reply_markup()
     await call.message.answer("❌ Создание конкурса отменено.")
     await state.clear()
@@ -204,7 +2589,7 @@ async def publish_contest(message: Message, state: FSMContext):
     data = await state.get_data()
 
     try:
-        chat = await bot.get_chat(f"@{target}")
+        chat = await get_chat_cached(f"@{target}")
         member = await bot.get_chat_member(chat.id, user_id)
         if member.status not in ["administrator", "creator"]:
             await message.answer(
@@ -214,42 +2599,47 @@ async def publish_contest(message: Message, state: FSMContext):
             )
             return
 
-        contest_id = generate_contest_id(is_fast=False)
+        contest_id = await generate_contest_id(is_fast=False)
+        draw_seed = new_draw_seed().hex()
         text = (
             f"🎉 КОНКУРС �\n\n"
             f"Условия: {data['conditions']}\n\n"
             f"Подписаться на: {', '.join(f'@{ch}' for ch in data['channels'])}\n\n"
-            f"Победителей: {data['winner_count']}"
+            f"Победителей: {data['winner_count']}\n\n"
+            f"{format_draw_commitment(draw_seed)}"
         )
 
-        btn = InlineKeyboardButton(text="🎁 Участвовать", callback_data=f"join:{contest_id}")
-        msg = await bot.send_message(chat.id, text, reply_markup=InlineKeyboardMarkup(inline_keyboard=[[btn]]))
+        btn = InlineKeyboardButton(text="🎁 Участвовать", callback_data=JoinCallback(contest_id=contest_id).pack())
+        msg = await outbox.submit(
+            lambda: bot.send_message(chat.id, text, reply_markup=InlineKeyboardMarkup(inline_keyboard=[[btn]])),
+            chat.id
+        )
 
-        contests[contest_id] = {
+        register_contest(contest_id, {
             **data,
             'channel_id': chat.id,
+            'channel_username': chat.username,
+            'channel_username_at': time.time(),
             'message_id': msg.message_id,
             'creator_id': user_id,
             'is_active': True,
-            'is_fast': False
-        }
-        participants[contest_id] = []
+            'is_fast': False,
+            'draw_seed': draw_seed
+        })
+        if SHARED_STATE:
+            await storage.flush()  # кнопка участия в посте уже видна, конкурс нужен всем экземплярам
 
         # Notify admins about the new regular contest
-        for admin_id in ADMIN_IDS:
-            try:
-                await bot.send_message(
-                    admin_id,
-                    f"🆕 Новый конкурс создан (ID: {contest_id})\n"
-                    f"Канал: @{target}\n"
-                    f"Условия: {data['conditions']}\n"
-                    f"Подписаться на: {', '.join(f'@{ch}' for ch in data['channels'])}\n"
-                    f"Победителей: {data['winner_count']}"
-                )
-            except Exception as e:
-                logging.error(f"Ошибка при уведомлении админа {admin_id}: {e}")
+        notify_admins(
+            f"🆕 Новый конкурс создан (ID: {contest_id})\n"
+            f"Канал: @{target}\n"
+            f"Условия: {data['conditions']}\n"
+            f"Подписаться на: {', '.join(f'@{ch}' for ch in data['channels'])}\n"
+            f"Победителей: {data['winner_count']}"
+        )
 
-        await message.answer(
+        send_later(
+            user_id,
             f"✅ Конкурс опубликован в @{target}!\n"
             f"ID конкурса: {contest_id}\n"
             f"Используйте: @giveawaygasbot {contest_id} в inline-режиме для доступа к конкурсу."
@@ -260,123 +2650,193 @@ async def publish_contest(message: Message, state: FSMContext):
     finally:
         await state.clear()
 
-@dp.callback_query(lambda c: c.data.startswith("join"))
-async def join_contest(call: CallbackQuery):
+@callback_router.route(JoinCallback)
+async def join_contest(call: CallbackQuery, callback_data: JoinCallback, state: FSMContext):
     user = call.from_user
-    contest_id = call.data.split(":")[1]
-    contest = contests.get(contest_id)
+    contest_id = callback_data.contest_id
+    contest = await get_contest(contest_id)
 
-    if not contest or not contest['is_active']:
+    if not contest or not contest['is_active'] or contest.get('ends_at', float('inf')) <= time.time():
+        bot_stats.reject_join('not_found')
         await bot.answer_callback_query(call.id, "⚠️ Конкурс не найден или завершён", show_alert=True)
         return
 
-    unique_users.add(user.id)
+    changed_day = unique_users.add(user.id)
+    if changed_day:
+        storage.add_user(user.id, changed_day)
 
-    if any(p['user_id'] == user.id for p in participants.get(contest_id, [])):
+    if user.id in participants.get(contest_id, ()):
+        bot_stats.reject_join('already_joined')
         await bot.answer_callback_query(call.id, "Ты уже участвуешь!", show_alert=True)
         return
 
-    not_subbed = []
+    if join_pipeline.is_pending(contest_id, user.id):
+        # Повторное нажатие, пока первая заявка в очереди: ответ придёт на неё
+        await bot.answer_callback_query(call.id, "⏳ Проверяем подписку...")
+        return
+
+    if not join_pipeline.submit(JoinRequest(call.id, contest_id, user)):
+        bot_stats.reject_join('overloaded')
+        await bot.answer_callback_query(
+            call.id, "⏳ Сейчас очень много желающих, попробуй ещё раз через несколько секунд.", show_alert=True
+        )
+
+def accepts_joins(contest_id: str) -> bool:
+    contest = contests.get(contest_id)
+    return bool(contest) and contest['is_active'] and contest.get('ends_at', float('inf')) > time.time()
+
+async def admit_join(request: JoinRequest) -> None:
+    """Проверка подписок и регистрация участника; вызывается воркером JoinPipeline"""
+    call_id, contest_id, user = request.call_id, request.contest_id, request.user
+    if time.monotonic() - request.queued_at > JOIN_ANSWER_DEADLINE:
+        bot_stats.reject_join('overloaded')
+        await bot.answer_callback_query(
+            call_id, "⏳ Сейчас очень много желающих, попробуй ещё раз через несколько секунд.", show_alert=True
+        )
+        return
+
+    if not accepts_joins(contest_id):
+        bot_stats.reject_join('not_found')
+        await bot.answer_callback_query(call_id, "⚠️ Конкурс не найден или завершён", show_alert=True)
+        return
+
+    contest = contests[contest_id]
     if contest.get('is_fast', False):
-        try:
-            chat = await bot.get_chat(contest['channel_id'])
-            member = await bot.get_chat_member(contest['channel_id'], user.id)
-            if member.status not in ["member", "administrator", "creator"]:
-                not_subbed.append(chat.username or f"channel_{contest['channel_id']}")
-        except Exception:
-            not_subbed.append(chat.username or f"channel_{contest['channel_id']}")
+        # У ФАСТ конкурса проверяется канал публикации
+        channel_name = (contest.get('channels') or [f"channel_{contest['channel_id']}"])[0]
+        channels = [(channel_name, contest['channel_id'])]
     else:
-        for ch in contest.get('channels', []):
-            try:
-                chat = await bot.get_chat(f"@{ch}")
-                member = await bot.get_chat_member(chat.id, user.id)
-                if member.status not in ["member", "administrator", "creator"]:
-                    not_subbed.append(ch)
-            except Exception:
-                not_subbed.append(ch)
+        channels = [(ch, f"@{ch}") for ch in contest.get('channels', [])]
+    not_subbed, unverified = await find_missing_subscriptions(channels, user.id)
+
+    if not_subbed or unverified:
+        bot_stats.reject_join('not_subscribed' if not_subbed else 'check_failed')
+        alert_text = "Проверь подписку!\n" + "\n".join(
+            [f"Ты не подписан на @{ch}" for ch in not_subbed]
+            + [f"Не удалось проверить @{ch}, попробуй ещё раз" for ch in unverified]
+        )
+        await bot.answer_callback_query(call_id, alert_text, show_alert=True)
+        return
 
-    if not_subbed:
-        alert_text = "Проверь подписку!\n" + "\n".join(f"Ты не подписан на @{ch}" for ch in not_subbed)
-        await bot.answer_callback_query(call.id, alert_text, show_alert=True)
+    # Пока запрос ждал в очереди и проверке подписок, итоги могли уже подвести
+    if not accepts_joins(contest_id):
+        bot_stats.reject_join('not_found')
+        await bot.answer_callback_query(call_id, "⚠️ Конкурс завершён", show_alert=True)
         return
 
-    participants.setdefault(contest_id, []).append({
-        'user_id': user.id,
-        'username': user.username if user.username else None,
-        'name': user.full_name
-    })
+    if not await add_participant(contest_id, user):
+        bot_stats.reject_join('already_joined')
+        await bot.answer_callback_query(call_id, "Ты уже участвуешь!", show_alert=True)
+        return
+
+    await bot.answer_callback_query(call_id, "Ты успешно участвуешь!", show_alert=True)
 
-    await bot.answer_callback_query(call.id, "Ты успешно участвуешь!", show_alert=True)
+join_pipeline = JoinPipeline(admit_join)
 
-@dp.callback_query(lambda c: c.data == "stats")
-async def show_stats(call: CallbackQuery):
+@callback_router.route(StatsCallback)
+async def show_stats(call: CallbackQuery, callback_data: StatsCallback, state: FSMContext):
     if not is_admin(call.from_user.id):
         await call.message.answer("❌ Доступ только для админов.")
         return
     await call.message.answer(get_statistics())
     await call.message.delete()
 
-@dp.callback_query(lambda c: c.data == "pick_winners")
-async def pick_winners(call: CallbackQuery, state: FSMContext):
-    user_id = call.from_user.id
+CONTEST_PICKERS = {
+    'pick': (active_by_creator, PickCallback, CancelPickCallback, "📋 Выберите конкурс для подведения итогов:"),
+    'reroll': (finished_by_creator, RerollCallback, CancelRerollCallback, "📋 Выберите конкурс для пересмотра победителей:"),
+}
+
+def contest_label(contest_id: str) -> str:
+    if contest_id in contests:
+        contest = contests[contest_id]
+        is_fast, channel_id, channel_username = contest.get('is_fast', False), contest['channel_id'], contest.get('channel_username')
+    else:
+        stub = archived_contests[contest_id]
+        is_fast, channel_id, channel_username = stub.is_fast, stub.channel_id, stub.channel_username
+    kind = 'ФАСТ Конкурс' if is_fast else 'Конкурс'
+    channel = f"@{channel_username}" if channel_username else f"канале {channel_id}"
+    return f"{kind} в {channel} (ID: {contest_id})"
+
+def render_contest_picker(kind: str, user_id: int, page: int) -> Optional[Tuple[str, InlineKeyboardMarkup]]:
+    """Страница меню выбора конкурса; None - если у пользователя нет таких конкурсов"""
+    index, item_factory, cancel_factory, title = CONTEST_PICKERS[kind]
+    contest_ids = list(index.get(user_id, ()))
+    if not contest_ids:
+        return None
+    contest_ids.reverse()  # новые конкурсы первыми
+    pages = -(-len(contest_ids) // CONTEST_PICKER_PAGE_SIZE)
+    page = min(page, pages - 1)
+    shown = contest_ids[page * CONTEST_PICKER_PAGE_SIZE:(page + 1) * CONTEST_PICKER_PAGE_SIZE]
+    fill_channel_usernames_later(shown)
+
+    kb = InlineKeyboardBuilder()
+    for contest_id in shown:
+        kb.button(text=contest_label(contest_id), callback_data=item_factory(contest_id=contest_id))
+    nav = 0
+    if page > 0:
+        kb.button(text="◀️", callback_data=ContestPageCallback(kind=kind, page=page - 1))
+        nav += 1
+    if page < pages - 1:
+        kb.button(text="▶️", callback_data=ContestPageCallback(kind=kind, page=page + 1))
+        nav += 1
+    kb.button(text="Отмена", callback_data=cancel_factory())
+    kb.adjust(*([1] * len(shown)), *([nav] if nav else []), 1)
+    text = f"{title}\n\nСтраница {page + 1}/{pages}" if pages > 1 else title
+    return text, kb.as_markup()
+
+@callback_router.route(PickMenuCallback)
+async def pick_winners(call: CallbackQuery, callback_data: PickMenuCallback, state: FSMContext):
     if call.message.chat.type != "private":
         await call.message.answer("ℹ️ Используйте эту команду в личных сообщениях с ботом.")
         return
 
-    active_contests = [(cid, c) for cid, c in contests.items() 
-                      if c['is_active'] and c['creator_id'] == user_id]
-    
-    if not active_contests:
+    picker = render_contest_picker('pick', call.from_user.id, 0)
+    if not picker:
         await call.message.answer("❌ Нет активных конкурсов, созданных вами.")
         await call.message.delete()
         return
 
-    kb = InlineKeyboardBuilder()
-    for contest_id, contest in active_contests:
-        try:
-            chat = await bot.get_chat(contest['channel_id'])
-            kb.button(text=f"{'ФАСТ Конкурс' if contest.get('is_fast', False) else 'Конкурс'} в @{chat.username} (ID: {contest_id})", callback_data=f"pick:{contest_id}")
-        except Exception as e:
-            logging.error(f"Ошибка при получении чата в pick_winners: {e}")
-    kb.button(text="Отмена", callback_data="cancel_pick")
-    kb.adjust(1)
-
-    await call.message.answer("📋 Выберите конкурс для подведения итогов:", reply_markup=kb.as_markup())
+    text, markup = picker
+    await call.message.answer(text, reply_markup=markup)
     await call.message.delete()
 
-@dp.callback_query(lambda c: c.data == "reroll_winners")
-async def reroll_winners(call: CallbackQuery, state: FSMContext):
-    user_id = call.from_user.id
+@callback_router.route(RerollMenuCallback)
+async def reroll_winners(call: CallbackQuery, callback_data: RerollMenuCallback, state: FSMContext):
     if call.message.chat.type != "private":
         await call.message.answer("ℹ️ Используйте эту команду в личных сообщениях с ботом.")
         return
 
-    finished_contests = [(cid, c) for cid, c in contests.items() 
-                        if not c['is_active'] and c['creator_id'] == user_id]
-    
-    if not finished_contests:
+    picker = render_contest_picker('reroll', call.from_user.id, 0)
+    if not picker:
         await call.message.answer("❌ Нет завершенных конкурсов, созданных вами.")
         await call.message.delete()
         return
 
-    kb = InlineKeyboardBuilder()
-    for contest_id, contest in finished_contests:
-        try:
-            chat = await bot.get_chat(contest['channel_id'])
-            kb.button(text=f"{'ФАСТ Конкурс' if contest.get('is_fast', False) else 'Конкурс'} в @{chat.username} (ID: {contest_id})", callback_data=f"reroll:{contest_id}")
-        except Exception as e:
-            logging.error(f"Ошибка при получении чата в reroll_winners: {e}")
-    kb.button(text="Отмена", callback_data="cancel_reroll")
-    kb.adjust(1)
-
-    await call.message.answer("📋 Выберите конкурс для пересмотра победителей:", reply_markup=kb.as_markup())
+    text, markup = picker
+    await call.message.answer(text, reply_markup=markup)
     await call.message.delete()
 
-@dp.callback_query(lambda c: c.data.startswith("pick:") or c.data.startswith("reroll:"))
-async def select_contest_for_winners(call: CallbackQuery, state: FSMContext):
+@callback_router.route(ContestPageCallback)
+async def contest_page_callback(call: CallbackQuery, callback_data: ContestPageCallback, state: FSMContext):
+    picker = render_contest_picker(callback_data.kind, call.from_user.id, callback_data.page)
+    if not picker:
+        await bot.answer_callback_query(call.id, "❌ Конкурсов больше нет.", show_alert=True)
+        await call.message.delete()
+        return
+    text, markup = picker
+    await call.message.edit_text(text, reply_markup=markup)
+    await bot.answer_callback_query(call.id)
+
+@callback_router.route(PickCallback)
+@callback_router.route(RerollCallback)
+async def select_contest_for_winners(
+    call: CallbackQuery,
+    callback_data: Union[PickCallback, RerollCallback],
+    state: FSMContext
+):
     user_id = call.from_user.id
-    contest_id = call.data.split(":")[1]
-    contest = contests.get(contest_id)
+    contest_id = callback_data.contest_id
+    contest = await get_contest(contest_id)
 
     if not contest:
         await call.message.answer("❌ Конкурс не найден.")
@@ -388,7 +2848,7 @@ async def select_contest_for_winners(call: CallbackQuery, state: FSMContext):
         await call.message.edit_reply_markup()
         return
 
-    users = participants.get(contest_id, [])
+    users = participants.get(contest_id)
     if not users:
         await call.message.answer("😢 Нет участников для выбора победителей.")
         await call.message.edit_reply_markup()
@@ -396,18 +2856,25 @@ async def select_contest_for_winners(call: CallbackQuery, state: FSMContext):
 
     try:
         if is_admin(user_id):
-            text = "📋 Участники конкурса (для справки):\n\n" + (
-                "\n".join(
-                    f"{i+1}. @{u['username']} ({u['user_id']})" if u['username'] 
-                    else f"{i+1}. {u['name']} ({u['user_id']})"
-                    for i, u in enumerate(users)
-                ) if users else "😢 Нет участников."
-            )
+            page_text, page_kb = render_participants_page(contest_id, 0)
+            await call.message.answer(page_text, reply_markup=page_kb)
+            text = f"👥 Участников: {len(users)}"
+            is_reroll = isinstance(callback_data, RerollCallback)
+            kb = InlineKeyboardBuilder()
+            kb.button(text="🎲 Случайный розыгрыш", callback_data=DrawCallback(contest_id=contest_id))
+            if is_reroll and contest.get('winners'):
+                text += "\n\n🏆 Текущие победители:\n" + "\n".join(
+                    f"{i+1}. {format_winners([w])}" for i, w in enumerate(contest['winners'])
+                )
+                kb.button(text="🎲 Перевыбрать отдельные места", callback_data=RedrawCallback(contest_id=contest_id))
+            kb.adjust(1)
             await call.message.answer(
                 f"{text}\n\n"
-                f"🔢 Укажите Telegram usernames или IDs победителей через запятую (например: @username1, @username2 или 123456789, 987654321):"
+                f"🔢 Укажите Telegram usernames или IDs победителей через запятую (например: @username1, @username2 или 123456789, 987654321) "
+                f"или выберите случайный розыгрыш:",
+                reply_markup=kb.as_markup()
             )
-            await state.update_data(contest_id=contest_id, is_reroll=call.data.startswith("reroll:"))
+            await state.update_data(contest_id=contest_id, is_reroll=is_reroll)
             await state.set_state(ContestStates.waiting_for_winners)
         else:
             await call.message.answer(
@@ -423,6 +2890,42 @@ async def select_contest_for_winners(call: CallbackQuery, state: FSMContext):
         await call.message.answer(f"❌ Ошибка при выборе победителей: {e}")
         await call.message.edit_reply_markup()
 
+async def get_listed_contest(call: CallbackQuery, contest_id: str) -> Optional[Dict]:
+    """Список участников доступен создателю конкурса, если он админ бота"""
+    contest = await get_contest(contest_id)
+    if not contest or contest['creator_id'] != call.from_user.id or not is_admin(call.from_user.id):
+        await bot.answer_callback_query(call.id, "❌ Конкурс не найден или недоступен.", show_alert=True)
+        return None
+    return contest
+
+@callback_router.route(ParticipantsPageCallback)
+async def participants_page_callback(call: CallbackQuery, callback_data: ParticipantsPageCallback, state: FSMContext):
+    if not await get_listed_contest(call, callback_data.contest_id):
+        return
+    text, kb = render_participants_page(callback_data.contest_id, callback_data.page)
+    try:
+        await call.message.edit_text(text, reply_markup=kb)
+    except TelegramBadRequest as e:
+        # Нажатие на текущую страницу: текст не изменился
+        if "message is not modified" not in str(e):
+            raise
+    await bot.answer_callback_query(call.id)
+
+@callback_router.route(ParticipantsExportCallback)
+async def participants_export_callback(call: CallbackQuery, callback_data: ParticipantsExportCallback, state: FSMContext):
+    contest_id = callback_data.contest_id
+    if not await get_listed_contest(call, contest_id):
+        return
+    await bot.answer_callback_query(call.id, "⏳ Готовлю файл...")
+    try:
+        await call.message.answer_document(
+            ParticipantsCSV(contest_id),
+            caption=f"📄 Участники конкурса {contest_id}: {len(participants.get(contest_id, ()))}"
+        )
+    except Exception as e:
+        logging.error(f"Ошибка выгрузки участников конкурса {contest_id}: {e}")
+        await call.message.answer(f"❌ Не удалось выгрузить участников: {e}")
+
 @dp.message(ContestStates.waiting_for_winners)
 async def winners_selected(message: Message, state: FSMContext):
     user_id = message.from_user.id
@@ -437,7 +2940,7 @@ async def winners_selected(message: Message, state: FSMContext):
 
     data = await state.get_data()
     contest_id = data['contest_id']
-    contest = contests.get(contest_id)
+    contest = await get_contest(contest_id, fresh=True)
 
     if not contest:
         await message.answer("❌ Конкурс не найден.")
@@ -456,53 +2959,113 @@ async def winners_selected(message: Message, state: FSMContext):
             await message.answer(f"❌ Укажите ровно {count} победителей.")
             return
 
-        winners = []
-        for input_id in winner_inputs:
-            user_id_input = input_id.replace('@', '') if input_id.startswith('@') else input_id
-            try:
-                user_id_input = int(user_id_input)
-                try:
-                    user = await bot.get_chat(user_id_input)
-                    winners.append({
-                        'user_id': user_id_input,
-                        'username': user.username if user.username else None,
-                        'name': user.full_name
-                    })
-                except:
-                    winners.append({
-                        'user_id': user_id_input,
-                        'username': None,
-                        'name': f"User {user_id_input}"
-                    })
-            except ValueError:
-                winners.append({
-                    'user_id': None,
-                    'username': user_id_input,
-                    'name': user_id_input
-                })
-
-        winners_text = "🏆 Победители конкурса: " + ", ".join(
-            f"@{w['username']}" if w['username'] else w['name']
-            for w in winners
-        )
+        winners, outsiders = await resolve_winners(contest_id, winner_inputs)
+
+        winners_text = "🏆 Победители конкурса: " + format_winners(winners)
 
+        members = [w for w in winners if w not in outsiders]
+        report = f"✅ Участники конкурса: {format_winners(members) if members else 'нет'}"
+        if outsiders:
+            report += f"\n⚠️ Не участвовали в конкурсе: {format_winners(outsiders)}"
         await message.answer(
-            f"📋 Вы выбрали победителями:\n\n{winners_text}\n\n"
+            f"📋 Вы выбрали победителями:\n\n{winners_text}\n\n{report}\n\n"
             f"🔗 Отправьте ссылку для кнопки 'Проверить результаты' (или 'нет', если ссылки нет):"
         )
-        await state.update_data(winners_text=winners_text, winners=winners)
+        await state.update_data(winners_text=winners_text, winners=winners, draws=[])
         await state.set_state(ContestStates.waiting_for_results_link)
     except Exception as e:
         logging.error(f"Ошибка в winners_selected: {e}")
         await message.answer(f"❌ Ошибка: {e}. Укажите usernames или IDs через запятую.")
         return
 
+async def get_draw_contest(call: CallbackQuery, contest_id: str, state: FSMContext) -> Optional[Dict]:
+    """Проверки перед розыгрышем: конкурс выбран в этом диалоге, пользователь - создатель и админ"""
+    data = await state.get_data()
+    contest = await get_contest(contest_id, fresh=True)
+    if not contest or data.get('contest_id') != contest_id:
+        await call.message.answer("❌ Конкурс не найден. Выберите его заново через /start.")
+    elif contest['creator_id'] != call.from_user.id:
+        await call.message.answer("❌ Вы не являетесь создателем этого конкурса.")
+    elif not is_admin(call.from_user.id):
+        await call.message.answer(
+            "⚠️ Ошибка\n"
+            "❌ Вы не являетесь администратором\n"
+            "Обратитесь к администратору - @icaacull"
+        )
+    elif not participants.get(contest_id):
+        await call.message.answer("😢 Нет участников для выбора победителей.")
+    else:
+        await call.message.edit_reply_markup()
+        return contest
+    await call.message.edit_reply_markup()
+    await state.clear()
+    return None
+
+async def offer_results_link(message: Message, state: FSMContext, winners: List[Dict], draws: List[Dict]):
+    winners_text = "🏆 Победители конкурса: " + format_winners(winners) + "\n\n" + format_draws(draws)
+    await message.answer(
+        f"📋 Победители выбраны случайно:\n\n{winners_text}\n\n"
+        f"🔗 Отправьте ссылку для кнопки 'Проверить результаты' (или 'нет', если ссылки нет):"
+    )
+    await state.update_data(winners_text=winners_text, winners=winners, draws=draws)
+    await state.set_state(ContestStates.waiting_for_results_link)
+
+@callback_router.route(DrawCallback)
+async def random_draw_callback(call: CallbackQuery, callback_data: DrawCallback, state: FSMContext):
+    contest = await get_draw_contest(call, callback_data.contest_id, state)
+    if not contest:
+        return
+    winners, draw = draw_winners(callback_data.contest_id, contest['winner_count'])
+    await offer_results_link(call.message, state, winners, [draw])
+
+@callback_router.route(RedrawCallback)
+async def redraw_callback(call: CallbackQuery, callback_data: RedrawCallback, state: FSMContext):
+    contest = await get_draw_contest(call, callback_data.contest_id, state)
+    if not contest:
+        return
+    if not contest.get('winners'):
+        await call.message.answer("❌ У конкурса нет сохранённых победителей, проведите розыгрыш заново.")
+        return
+    await call.message.answer("🔢 Укажите номера мест для замены через запятую (например: 1, 3):")
+    await state.set_state(ContestStates.waiting_for_reroll_slots)
+
+@dp.message(ContestStates.waiting_for_reroll_slots)
+async def reroll_slots_selected(message: Message, state: FSMContext):
+    data = await state.get_data()
+    contest_id = data['contest_id']
+    contest = await get_contest(contest_id, fresh=True)
+    if not contest or contest['creator_id'] != message.from_user.id or not is_admin(message.from_user.id):
+        await message.answer("❌ Конкурс не найден или недоступен.")
+        await state.clear()
+        return
+
+    current = contest.get('winners') or []
+    try:
+        slots = sorted({int(part) for part in message.text.split(',') if part.strip()})
+        if not slots or slots[0] < 1 or slots[-1] > len(current):
+            raise ValueError
+    except ValueError:
+        await message.answer(f"❌ Укажите номера мест от 1 до {len(current)} через запятую.")
+        return
+
+    # Все текущие победители исключаются, чтобы замена не совпала ни с кем из них
+    replacements, draw = draw_winners(contest_id, len(slots), keep=current)
+    if len(replacements) < len(slots):
+        await message.answer("😢 Недостаточно участников для замены.")
+        return
+
+    winners = list(current)
+    for slot, winner in zip(slots, replacements):
+        winners[slot - 1] = winner
+    draw['slots'] = slots
+    await offer_results_link(message, state, winners, (contest.get('draws') or []) + [draw])
+
 @dp.message(ContestStates.waiting_for_results_link)
 async def publish_results(message: Message, state: FSMContext):
     user_id = message.from_user.id
     data = await state.get_data()
     contest_id = data['contest_id']
-    contest = contests.get(contest_id)
+    contest = await get_contest(contest_id)
 
     if not contest:
         await message.answer("❌ Конкурс не найден.")
@@ -530,31 +3093,31 @@ async def publish_results(message: Message, state: FSMContext):
 
     try:
         winners_text = data['winners_text']
-        if contest.get('is_fast', False):
-            updated_text = f"{contest['conditions']}\n\n{winners_text}"
-        else:
-            updated_text = (
-                f"🎉КОНКУРС🎉\n\n"
-                f"Условия: {contest['conditions']}\n\n"
-                f"Подписаться на: {', '.join(f'@{ch}' for ch in contest['channels'])}\n\n"
-                f"Победителей: {contest['winner_count']}\n\n"
-                f"{winners_text}"
-            )
+        updated_text = format_results_text(contest, winners_text)
 
         kb = InlineKeyboardBuilder()
         if results_link:
             results_links[contest_id] = results_link
+            storage.save_results_link(contest_id, results_link)
             kb.button(text="🔍 Проверить результаты", url=results_link)
         kb.adjust(1)
 
-        await bot.edit_message_text(
-            chat_id=contest['channel_id'],
-            message_id=contest['message_id'],
-            text=updated_text,
-            reply_markup=kb.as_markup() if results_link else None
+        await outbox.submit(
+            lambda: bot.edit_message_text(
+                chat_id=contest['channel_id'],
+                message_id=contest['message_id'],
+                text=updated_text,
+                reply_markup=kb.as_markup() if results_link else None
+            ),
+            contest['channel_id']
         )
 
-        contests[contest_id]['is_active'] = False
+        contest['winners'] = data['winners']
+        contest['draws'] = data.get('draws') or []
+        if contest['draws']:
+            # Следующий перевыбор получит новый раунд только после публикации этого
+            contest['draw_rounds'] = contest['draws'][-1].get('round', 0) + 1
+        finish_contest(contest_id)
         await message.answer("✅ Итоги конкурса опубликованы в исходном посте!")
     except Exception as e:
         logging.error(f"Ошибка в publish_results: {e}")
@@ -562,207 +3125,322 @@ async def publish_results(message: Message, state: FSMContext):
     finally:
         await state.clear()
 
-@dp.callback_query(lambda c: c.data == "cancel_pick")
-async def cancel_pick_callback(call: CallbackQuery, state: FSMContext):
+@callback_router.route(CancelPickCallback)
+async def cancel_pick_callback(call: CallbackQuery, callback_data: CancelPickCallback, state: FSMContext):
     await call.message.edit_reply_markup()
     await call.message.answer("❌ Подведение итогов отменено.")
     await state.clear()
 
-@dp.callback_query(lambda c: c.data == "cancel_reroll")
-async def cancel_reroll_callback(call: CallbackQuery, state: FSMContext):
+@callback_router.route(CancelRerollCallback)
+async def cancel_reroll_callback(call: CallbackQuery, callback_data: CancelRerollCallback, state: FSMContext):
     await call.message.edit_reply_markup()
     await call.message.answer("❌ Пересмотр победителей отменен.")
     await state.clear()
 
-@dp.inline_query()
-async def inline_query_handler(query: InlineQuery):
-    query_text = query.query.strip()
-    user_id = query.from_user.id
+def format_fast_text(draft: Dict) -> str:
+    return (
+        f"🎉 ФАСТ КОНКУРС 🎉\n\n"
+        f"Условия: {draft['description']}\n\n"
+        f"Подписаться на: @{draft['target_channel']}\n\n"
+        f"Победителей: {draft['winner_count']}\n\n"
+        f"Длительность: {draft['minutes']} минут"
+    )
 
-    if query_text.startswith("conc "):
+def fast_draft_key(draft: Dict) -> str:
+    """Ключ идемпотентности одного предпросмотра: повторные нажатия его кнопки дают один конкурс.
+
+    nonce отличает предпросмотры с одинаковыми параметрами: тот же запрос после завершения
+    конкурса публикует новый, а не отвечает ссылкой на старый.
+    """
+    raw = (
+        f"{draft['user_id']}|{' '.join(draft['description'].split())}|{draft['winner_count']}|"
+        f"{draft['minutes']}|{draft['target_channel'].lower()}|{draft['nonce']}"
+    )
+    return hashlib.sha256(raw.encode()).hexdigest()[:16]
+
+# Предпросмотры ФАСТ конкурсов и уже опубликованные по ним конкурсы (None - публикация идёт)
+fast_drafts = TTLCache(CACHE_MAX_SIZE, FAST_DRAFT_TTL)
+fast_published = TTLCache(CACHE_MAX_SIZE, FAST_DRAFT_TTL)
+pending_fast_queries: Dict[int, asyncio.Task] = {}
+
+def fast_draft_state(user_id: int) -> FSMContext:
+    """Отдельный слот FSM автора для предпросмотров: кнопку может нажать другой экземпляр бота"""
+    key = StorageKey(bot_id=bot.id, chat_id=user_id, user_id=user_id, destiny='fast_draft')
+    return FSMContext(storage=dp.storage, key=key)
+
+async def save_fast_draft(key: str, draft: Dict) -> None:
+    fast_drafts.set(key, draft)
+    if SHARED_STATE:
+        state = fast_draft_state(draft['user_id'])
+        now = time.time()
+        stored = {k: d for k, d in (await state.get_data()).items() if d['expires'] > now}
+        stored[key] = {**draft, 'expires': now + FAST_DRAFT_TTL}
+        await state.set_data(stored)
+
+async def pop_fast_draft(key: str, user_id: int) -> Optional[Dict]:
+    """Забирает предпросмотр для публикации; None - устарел или принадлежит другому пользователю"""
+    draft = fast_drafts.get(key)
+    fast_drafts.invalidate(key)
+    if SHARED_STATE:
+        state = fast_draft_state(user_id)
+        stored = await state.get_data()
+        if key in stored:
+            shared = stored.pop(key)
+            await state.set_data(stored)
+            if draft is None and shared['expires'] > time.time():
+                draft = {k: v for k, v in shared.items() if k != 'expires'}
+    return draft
+
+def debounce_fast_query(query: InlineQuery) -> None:
+    """Отвечает на 'conc' только после паузы в наборе: Telegram присылает запрос на каждую букву"""
+    user_id = query.from_user.id
+    previous = pending_fast_queries.pop(user_id, None)
+    if previous:
+        previous.cancel()
+
+    async def answer_later():
+        await asyncio.sleep(FAST_DEBOUNCE)
+        if pending_fast_queries.get(user_id) is task:
+            del pending_fast_queries[user_id]
         try:
-            parts = query_text[5:].split()
-            if len(parts) < 3:
-                await query.answer(
-                    results=[
-                        InlineQueryResultArticle(
-                            id=str(uuid.uuid4()),
-                            title="Неверный формат",
-                            input_message_content=InputTextMessageContent(
-                                message_text="❌ Укажите описание, количество участников, время и (опционально) канал.\nПример: @giveawaygasbot conc Тест 3 5 @MyChannel"
-                            ),
-                            description="Формат: <описание> <участники> <минуты> [@канал]"
-                        )
-                    ],
-                    cache_time=1
-                )
-                return
+            await answer_fast_query(query)
+        except Exception as e:
+            logging.error(f"Ошибка в answer_fast_query: {e}")
 
-            potential_numbers = [p for p in reversed(parts) if not p.startswith('@')]
-            if len(potential_numbers) < 2:
-                await query.answer(
-                    results=[
-                        InlineQueryResultArticle(
-                            id=str(uuid.uuid4()),
-                            title="Ошибка",
-                            input_message_content=InputTextMessageContent(
-                                message_text="❌ Укажите количество участников и время (числа) перед каналом, если он указан."
-                            ),
-                            description="Формат: <описание> <участники> <минуты> [@канал]"
-                        )
-                    ],
-                    cache_time=1
-                )
-                return
+    task = asyncio.create_task(answer_later())
+    pending_fast_queries[user_id] = task
 
-            minutes = int(potential_numbers[0])
-            winner_count = int(potential_numbers[1])
-            if winner_count <= 0 or minutes <= 0:
-                raise ValueError("Количество участников и время должны быть больше 0")
-
-            description_parts = [p for p in parts if not p.startswith('@') and not p.isdigit()]
-            description = " ".join(description_parts)
-
-            target_channel = next((p.replace('@', '').strip() for p in parts if p.startswith('@')), None)
-
-            if not target_channel:
-                await query.answer(
-                    results=[
-                        InlineQueryResultArticle(
-                            id=str(uuid.uuid4()),
-                            title="Ошибка",
-                            input_message_content=InputTextMessageContent(
-                                message_text="❌ Укажите канал (например @MyChannel)."
-                            ),
-                            description="Формат: <описание> <участники> <минуты> [@канал]"
-                        )
-                    ],
-                    cache_time=1
-                )
-                return
+async def answer_fast_query(query: InlineQuery):
+    """Предпросмотр ФАСТ конкурса по запросу 'conc <описание> <участники> <минуты> @канал'"""
+    query_text = query.query.strip()
+    user_id = query.from_user.id
 
-            try:
-                chat = await bot.get_chat(f"@{target_channel}")
-                member = await bot.get_chat_member(chat.id, user_id)
-                if member.status not in ["administrator", "creator"]:
-                    await query.answer(
-                        results=[
-                            InlineQueryResultArticle(
-                                id=str(uuid.uuid4()),
-                                title="Ошибка",
-                                input_message_content=InputTextMessageContent(
-                                    message_text=
-                                    "⚠️ Ошибка\n"
-                                    "❌ Вы не являетесь администратором канала\n"
-                                    "Обратитесь к администратору - @icaacull"
-                                ),
-                                description="Только администраторы могут создавать конкурсы."
-                            )
-                        ],
-                        cache_time=1
+    try:
+        parts = query_text[5:].split()
+        if len(parts) < 3:
+            await query.answer(
+                results=[
+                    InlineQueryResultArticle(
+                        id=str(uuid.uuid4()),
+                        title="Неверный формат",
+                        input_message_content=InputTextMessageContent(
+                            message_text="❌ Укажите описание, количество участников, время и (опционально) канал.\nПример: @giveawaygasbot conc Тест 3 5 @MyChannel"
+                        ),
+                        description="Формат: <описание> <участники> <минуты> [@канал]"
                     )
-                    return
-
-                # Публикуем конкурс сразу
-                contest_id = generate_contest_id(is_fast=True)
-                text = (
-                    f"🎉 ФАСТ КОНКУРС 🎉\n\n"
-                    f"Условия: {description}\n\n"
-                    f"Подписаться на: @{target_channel}\n\n"
-                    f"Победителей: {winner_count}\n\n"
-                    f"Длительность: {minutes} минут"
-                )
+                ],
+                cache_time=INLINE_CACHE_TIME_HELP
+            )
+            return
 
-                btn = InlineKeyboardButton(text="🎁 Участвовать", callback_data=f"join:{contest_id}")
-                msg = await bot.send_message(chat.id, text, reply_markup=InlineKeyboardMarkup(inline_keyboard=[[btn]]))
-
-                contests[contest_id] = {
-                    'conditions': text,
-                    'winner_count': winner_count,
-                    'channel_id': chat.id,
-                    'message_id': msg.message_id,
-                    'creator_id': user_id,
-                    'is_active': True,
-                    'is_fast': True,
-                    'duration_minutes': minutes,
-                    'channels': [target_channel]
-                }
-                participants[contest_id] = []
-
-                # Notify admins about the new fast contest
-                for admin_id in ADMIN_IDS:
-                    try:
-                        await bot.send_message(
-                            admin_id,
-                            f"🆕 Новый ФАСТ конкурс создан (ID: {contest_id})\n"
-                            f"Канал: @{target_channel}\n"
-                            f"Условия: {description}\n"
-                            f"Подписаться на: @{target_channel}\n"
-                            f"Победителей: {winner_count}\n"
-                            f"Длительность: {minutes} минут"
-                        )
-                    except Exception as e:
-                        logging.error(f"Ошибка при уведомлении админа {admin_id}: {e}")
-
-                # Notify creator in private messages
-                await bot.send_message(
-                    user_id,
-                    f"✅ ФАСТ Конкурс опубликован в @{target_channel}!\nID: {contest_id}\n"
-                    f"Используйте: @giveawaygasbot {contest_id} в inline-режиме для доступа к конкурсу."
-                )
+        potential_numbers = [p for p in reversed(parts) if not p.startswith('@')]
+        if len(potential_numbers) < 2:
+            await query.answer(
+                results=[
+                    InlineQueryResultArticle(
+                        id=str(uuid.uuid4()),
+                        title="Ошибка",
+                        input_message_content=InputTextMessageContent(
+                            message_text="❌ Укажите количество участников и время (числа) перед каналом, если он указан."
+                        ),
+                        description="Формат: <описание> <участники> <минуты> [@канал]"
+                    )
+                ],
+                cache_time=INLINE_CACHE_TIME_HELP
+            )
+            return
 
-                # Show preview in inline query results
-                kb = InlineKeyboardBuilder()
-                kb.button(text="🎁 Участвовать", callback_data=f"join:{contest_id}")
-                kb.adjust(1)
-
-                await query.answer(
-                    results=[
-                        InlineQueryResultArticle(
-                            id=str(uuid.uuid4()),
-                            title=f"ФАСТ Конкурс в @{target_channel} (ID: {contest_id})",
-                            input_message_content=InputTextMessageContent(
-                                message_text=text
-                            ),
-                            description=description[:100] + ("..." if len(description) > 100 else ""),
-                            reply_markup=kb.as_markup()
-                        )
-                    ],
-                    cache_time=1
-                )
-            except Exception as e:
-                logging.error(f"Ошибка при создании ФАСТ конкурса: {e}")
-                await query.answer(
-                    results=[
-                        InlineQueryResultArticle(
-                            id=str(uuid.uuid4()),
-                            title="Ошибка",
-                            input_message_content=InputTextMessageContent(
-                                message_text=f"❌ Ошибка публикации: {e}\nПопробуйте создать конкурс через /start."
-                            ),
-                            description="Убедитесь, что канал существует и бот добавлен."
-                        )
-                    ],
-                    cache_time=1
-                )
-                return
-        except ValueError as e:
-            logging.error(f"Ошибка при создании ФАСТ конкурса: {e}")
+        minutes = int(potential_numbers[0])
+        winner_count = int(potential_numbers[1])
+        if winner_count <= 0 or minutes <= 0:
+            raise ValueError("Количество участников и время должны быть больше 0")
+
+        description_parts = [p for p in parts if not p.startswith('@') and not p.isdigit()]
+        description = " ".join(description_parts)
+
+        target_channel = next((p.replace('@', '').strip() for p in parts if p.startswith('@')), None)
+
+        if not target_channel:
             await query.answer(
                 results=[
                     InlineQueryResultArticle(
                         id=str(uuid.uuid4()),
                         title="Ошибка",
                         input_message_content=InputTextMessageContent(
-                            message_text=f"❌ {e}\nФормат: @giveawaygasbot conc <описание> <участники> <минуты> [@канал]"
+                            message_text="❌ Укажите канал (например @MyChannel)."
                         ),
-                        description="Проверьте формат запроса."
+                        description="Формат: <описание> <участники> <минуты> [@канал]"
                     )
                 ],
-                cache_time=1
+                cache_time=INLINE_CACHE_TIME_HELP
             )
+            return
+
+        # Здесь только предпросмотр: конкурс публикуется кнопкой под ним
+        draft = {
+            'user_id': user_id,
+            'description': description,
+            'winner_count': winner_count,
+            'minutes': minutes,
+            'target_channel': target_channel,
+            'nonce': secrets.token_hex(8)
+        }
+        key = fast_draft_key(draft)
+        await save_fast_draft(key, draft)
+
+        kb = InlineKeyboardBuilder()
+        kb.button(text="✅ Опубликовать", callback_data=FastPublishCallback(key=key))
+        kb.adjust(1)
+
+        await query.answer(
+            results=[
+                InlineQueryResultArticle(
+                    id=key,
+                    title=f"ФАСТ Конкурс в @{target_channel} (предпросмотр)",
+                    input_message_content=InputTextMessageContent(
+                        message_text=format_fast_text(draft)
+                    ),
+                    description=description[:100] + ("..." if len(description) > 100 else ""),
+                    reply_markup=kb.as_markup()
+                )
+            ],
+            cache_time=1,
+            is_personal=True
+        )
+    except ValueError as e:
+        logging.error(f"Ошибка при создании ФАСТ конкурса: {e}")
+        await query.answer(
+            results=[
+                InlineQueryResultArticle(
+                    id=str(uuid.uuid4()),
+                    title="Ошибка",
+                    input_message_content=InputTextMessageContent(
+                        message_text=f"❌ {e}\nФормат: @giveawaygasbot conc <описание> <участники> <минуты> [@канал]"
+                    ),
+                    description="Проверьте формат запроса."
+                )
+            ],
+            cache_time=INLINE_CACHE_TIME_HELP
+        )
+
+@callback_router.route(FastPublishCallback)
+async def publish_fast_contest(call: CallbackQuery, callback_data: FastPublishCallback, state: FSMContext):
+    """Публикация ФАСТ конкурса из предпросмотра. Повторные нажатия конкурс не дублируют"""
+    key = callback_data.key
+    published = fast_published.get(key, _MISSING)
+    if published is not _MISSING:
+        await bot.answer_callback_query(
+            call.id,
+            f"✅ Конкурс уже опубликован (ID: {published})" if published else "⏳ Конкурс публикуется...",
+            show_alert=True
+        )
+        return
+
+    draft = fast_drafts.get(key)
+    if draft and draft['user_id'] != call.from_user.id:
+        await bot.answer_callback_query(call.id, "❌ Опубликовать конкурс может только его автор.", show_alert=True)
+        return
+
+    # Помечаем до первого await, чтобы параллельное нажатие не создало второй конкурс
+    fast_published.set(key, None)
+    draft = await pop_fast_draft(key, call.from_user.id)
+    if not draft:
+        fast_published.invalidate(key)
+        await bot.answer_callback_query(call.id, "⌛ Предпросмотр устарел, наберите запрос заново.", show_alert=True)
+        return
+    user_id = draft['user_id']
+    target_channel = draft['target_channel']
+    try:
+        chat = await get_chat_cached(f"@{target_channel}")
+        member = await bot.get_chat_member(chat.id, user_id)
+        if member.status not in ["administrator", "creator"]:
+            fast_published.invalidate(key)
+            await bot.answer_callback_query(
+                call.id,
+                "⚠️ Ошибка\n"
+                "❌ Вы не являетесь администратором канала\n"
+                "Обратитесь к администратору - @icaacull",
+                show_alert=True
+            )
+            return
+
+        contest_id = await generate_contest_id(is_fast=True)
+        draw_seed = new_draw_seed().hex()
+        text = f"{format_fast_text(draft)}\n\n{format_draw_commitment(draw_seed)}"
+
+        btn = InlineKeyboardButton(text="🎁 Участвовать", callback_data=JoinCallback(contest_id=contest_id).pack())
+        msg = await outbox.submit(
+            lambda: bot.send_message(chat.id, text, reply_markup=InlineKeyboardMarkup(inline_keyboard=[[btn]])),
+            chat.id
+        )
+
+        register_contest(contest_id, {
+            'conditions': text,
+            'winner_count': draft['winner_count'],
+            'channel_id': chat.id,
+            'channel_username': chat.username,
+            'channel_username_at': time.time(),
+            'message_id': msg.message_id,
+            'creator_id': user_id,
+            'is_active': True,
+            'is_fast': True,
+            'duration_minutes': draft['minutes'],
+            'ends_at': time.time() + draft['minutes'] * 60,
+            'channels': [target_channel],
+            'draw_seed': draw_seed
+        })
+        deadlines.schedule(contest_id, contests[contest_id]['ends_at'])
+        fast_published.set(key, contest_id)
+        if SHARED_STATE:
+            await storage.flush()
+    except Exception as e:
+        logging.error(f"Ошибка при создании ФАСТ конкурса: {e}")
+        fast_published.invalidate(key)
+        await save_fast_draft(key, draft)
+        await bot.answer_callback_query(
+            call.id,
+            f"❌ Ошибка публикации: {e}\nУбедитесь, что канал существует и бот добавлен.",
+            show_alert=True
+        )
         return
-    elif query_text.lower() == "concu":
+
+    # Notify admins about the new fast contest
+    notify_admins(
+        f"🆕 Новый ФАСТ конкурс создан (ID: {contest_id})\n"
+        f"Канал: @{target_channel}\n"
+        f"Условия: {draft['description']}\n"
+        f"Подписаться на: @{target_channel}\n"
+        f"Победителей: {draft['winner_count']}\n"
+        f"Длительность: {draft['minutes']} минут"
+    )
+
+    # Notify creator in private messages
+    send_later(
+        user_id,
+        f"✅ ФАСТ Конкурс опубликован в @{target_channel}!\nID: {contest_id}\n"
+        f"Используйте: @giveawaygasbot {contest_id} в inline-режиме для доступа к конкурсу."
+    )
+
+    # Предпросмотр превращается в пост конкурса с кнопкой участия
+    if call.inline_message_id:
+        outbox.enqueue(
+            lambda: bot.edit_message_text(
+                inline_message_id=call.inline_message_id,
+                text=text,
+                reply_markup=InlineKeyboardMarkup(inline_keyboard=[[btn]])
+            ),
+            call.inline_message_id
+        )
+    await bot.answer_callback_query(call.id, f"✅ Конкурс опубликован! ID: {contest_id}")
+
+@dp.inline_query()
+async def inline_query_handler(query: InlineQuery):
+    query_text = query.query.strip()
+
+    if query_text.startswith("conc "):
+        debounce_fast_query(query)
+        return
+    if query_text.lower() == "concu":
         await query.answer(
             results=[
                 InlineQueryResultArticle(
@@ -774,7 +3452,7 @@ async def inline_query_handler(query: InlineQuery):
                     description="Используйте 'conc' для создания ФАСТ конкурса."
                 )
             ],
-            cache_time=1
+            cache_time=INLINE_CACHE_TIME_HELP
         )
         return
 
@@ -791,7 +3469,7 @@ async def inline_query_handler(query: InlineQuery):
                     description="Укажите ID конкурса или используйте 'conc' для создания конкурса."
                 )
             ],
-            cache_time=1
+            cache_time=INLINE_CACHE_TIME_HELP
         )
         return
 
@@ -807,11 +3485,11 @@ async def inline_query_handler(query: InlineQuery):
                     description="Проверьте ID или используйте 'conc' для создания конкурса."
                 )
             ],
-            cache_time=1
+            cache_time=INLINE_CACHE_TIME_HELP
         )
         return
 
-    contest = contests.get(contest_id)
+    contest = await get_contest(contest_id)
     if not contest:
         await query.answer(
             results=[
@@ -824,31 +3502,15 @@ async def inline_query_handler(query: InlineQuery):
                     description="Проверьте правильность ID конкурса или создайте новый конкурс."
                 )
             ],
-            cache_time=1
+            cache_time=INLINE_CACHE_TIME_ACTIVE
         )
         return
 
     try:
-        chat = await bot.get_chat(contest['channel_id'])
-        text = contest['conditions']
-        kb = InlineKeyboardBuilder()
-        if contest['is_active']:
-            kb.button(text="🎁 Участвовать", callback_data=f"join:{contest_id}")
-        kb.adjust(1)
-
         await query.answer(
-            results=[
-                InlineQueryResultArticle(
-                    id=str(uuid.uuid4()),
-                    title=f"{'ФАСТ Конкурс' if contest.get('is_fast', False) else 'Конкурс'} в @{chat.username} (ID: {contest_id})",
-                    input_message_content=InputTextMessageContent(
-                        message_text=text
-                    ),
-                    description=contest['conditions'][:100] + ("..." if len(contest['conditions']) > 100 else ""),
-                    reply_markup=kb.as_markup() if contest['is_active'] else None
-                )
-            ],
-            cache_time=1
+            results=[await get_inline_result(contest_id)],
+            cache_time=INLINE_CACHE_TIME_ACTIVE if contest['is_active'] else INLINE_CACHE_TIME_FINISHED,
+            is_personal=False
         )
     except Exception as e:
         logging.error(f"Ошибка в inline_query_handler: {e}")
@@ -866,6 +3528,73 @@ async def inline_query_handler(query: InlineQuery):
             cache_time=1
         )
 
+register_metric(CallbackMetric(
+    'bot_cache_requests_total', 'Обращения к кэшам', 'counter', ('cache', 'result'),
+    lambda: [
+        ((name, result), cache.stats()[result])
+        for name, cache in (('chat', chat_cache), ('member', member_cache), ('inline', inline_cache))
+        for result in ('hits', 'misses', 'coalesced')
+    ]
+))
+register_metric(CallbackMetric(
+    'bot_contests', 'Конкурсы в памяти и в архиве', 'gauge', ('state',),
+    lambda: [
+        (('active',), sum(len(ids) for ids in active_by_creator.values())),
+        (('finished',), sum(len(ids) for ids in finished_by_creator.values()) - len(archived_contests)),
+        (('archived',), len(archived_contests))
+    ]
+))
+register_metric(CallbackMetric(
+    'bot_participants', 'Участники всех конкурсов', 'gauge', (),
+    lambda: [((), bot_stats.participants)]
+))
+register_metric(CallbackMetric(
+    'bot_queue_depth', 'Длина внутренних очередей', 'gauge', ('queue',),
+    lambda: [
+        (('outbox',), len(outbox)),
+        (('joins',), len(join_pipeline)),
+        (('updates',), update_queue.qsize()),
+        (('deadlines',), len(deadlines))
+    ]
+))
+
+def debug_allowed(request) -> bool:
+    token = request.headers.get('X-Debug-Token') or request.query.get('token', '')
+    return bool(DEBUG_TOKEN) and secrets.compare_digest(token, DEBUG_TOKEN)
+
+async def debug_loop_handler(request):
+    """Задержка цикла событий и пойманные блокировки"""
+    if not debug_allowed(request):
+        raise web.HTTPNotFound()
+    return web.json_response(loop_monitor.summary())
+
+async def debug_slow_handler(request):
+    """Последние медленные обработчики со стеками"""
+    if not debug_allowed(request):
+        raise web.HTTPNotFound()
+    return web.json_response(list(loop_monitor.slow_handlers))
+
+async def debug_profile_handler(request):
+    """Профиль цикла событий за ?seconds=N секунд"""
+    if not debug_allowed(request):
+        raise web.HTTPNotFound()
+    try:
+        seconds = min(float(request.query.get('seconds', '10')), PROFILE_MAX_SECONDS)
+    except ValueError:
+        raise web.HTTPBadRequest(text="seconds должно быть числом")
+    try:
+        profile = await asyncio.to_thread(loop_monitor.profile, seconds)
+    except RuntimeError as e:
+        raise web.HTTPConflict(text=str(e))
+    return web.Response(text=profile)
+
+async def metrics_handler(request):
+    """Метрики в формате Prometheus"""
+    return web.Response(
+        body=render_metrics().encode(),
+        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+    )
+
 async def health_check(request):
     """Endpoint для проверки работоспособности"""
     return web.json_response({
@@ -874,27 +3603,131 @@ async def health_check(request):
         "timestamp": str(datetime.now())
     })
 
+# ===== WEBHOOK =====
+update_queue: "asyncio.Queue[types.Update]" = asyncio.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+
+async def webhook_handler(request):
+    """Приём обновлений от Telegram: проверка секрета и постановка в очередь"""
+    token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if not secrets.compare_digest(token, WEBHOOK_SECRET):
+        return web.Response(status=401)
+
+    try:
+        update = types.Update.model_validate(await request.json(), context={"bot": bot})
+    except Exception as e:
+        logging.error(f"Некорректное обновление в webhook: {e}")
+        return web.Response(status=400)
+
+    try:
+        update_queue.put_nowait(update)
+    except asyncio.QueueFull:
+        # Telegram повторит доставку позже
+        logging.warning("Очередь обновлений переполнена, обновление отклонено")
+        return web.Response(status=503)
+    return web.Response()
+
+async def update_worker():
+    while True:
+        update = await update_queue.get()
+        try:
+            await dp.feed_update(bot, update)
+        except Exception as e:
+            logging.error(f"Ошибка обработки обновления {update.update_id}: {e}")
+        finally:
+            update_queue.task_done()
+
 async def start_web_server():
-    """Запуск веб-сервера на порту 8080"""
+    """Запуск веб-сервера на порту WEB_PORT (по умолчанию 8080)"""
     app = web.Application()
     app.router.add_get('/', health_check)
     app.router.add_get('/health', health_check)
+    app.router.add_get('/metrics', metrics_handler)
+    app.router.add_get('/debug/loop', debug_loop_handler)
+    app.router.add_get('/debug/slow', debug_slow_handler)
+    app.router.add_get('/debug/profile', debug_profile_handler)
+    if WEBHOOK_URL:
+        app.router.add_post(WEBHOOK_PATH, webhook_handler)
     
     runner = web.AppRunner(app)
     await runner.setup()
-    site = web.TCPSite(runner, '0.0.0.0', 8080)
+    site = web.TCPSite(runner, '0.0.0.0', WEB_PORT)
     await site.start()
-    logging.info("🌐 Веб-сервер запущен на порту 8080")
+    logging.info(f"🌐 Веб-сервер запущен на порту {WEB_PORT}")
+    return runner
+
+async def run_webhook():
+    """Работа через webhook до SIGTERM/SIGINT"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+
+    workers = [asyncio.create_task(update_worker()) for _ in range(WEBHOOK_WORKERS)]
+    runner = await start_web_server()
+    await bot.set_webhook(
+        f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types()
+    )
+    logging.info(f"🔗 Webhook установлен: {WEBHOOK_URL}{WEBHOOK_PATH}, обработчиков: {WEBHOOK_WORKERS}")
+    try:
+        await stop.wait()
+    finally:
+        # Новые обновления не принимаем, уже принятые дообрабатываем
+        await runner.cleanup()
+        try:
+            await asyncio.wait_for(update_queue.join(), timeout=10)
+        except asyncio.TimeoutError:
+            logging.warning(f"Не обработано обновлений при остановке: {update_queue.qsize()}")
+        for worker in workers:
+            worker.cancel()
+
+async def run_polling():
+    await bot.delete_webhook()
+    await asyncio.gather(
+        dp.start_polling(bot),
+        start_web_server()
+    )
+
+background_tasks: List[asyncio.Task] = []
+
+async def on_startup():
+    """Загрузка состояния и запуск фоновых задач"""
+    storage.open()
+    storage.load()
+    contest_ids.configure(bytes.fromhex(CONTEST_ID_KEY) if CONTEST_ID_KEY else storage.secret('contest_id_key'))
+    schedule_deadlines()
+    background_tasks.append(asyncio.create_task(storage.run()))
+    background_tasks.append(asyncio.create_task(outbox.run()))
+    background_tasks.append(asyncio.create_task(deadlines.run()))
+    background_tasks.append(asyncio.create_task(join_pipeline.run()))
+    background_tasks.append(asyncio.create_task(loop_monitor.run()))
+    if ARCHIVE_AFTER > 0:
+        background_tasks.append(asyncio.create_task(run_archiver()))
+
+async def on_shutdown():
+    await join_pipeline.drain(timeout=5)
+    await outbox.drain(timeout=5)
+    for task in background_tasks:
+        task.cancel()
+    background_tasks.clear()
+    await storage.close()
+    await dp.storage.close()
 
 async def main():
+    await on_startup()
     try:
-        await asyncio.gather(
-            dp.start_polling(bot),
-            start_web_server()
-        )
+        if WEBHOOK_URL:
+            await run_webhook()
+        else:
+            await run_polling()
     except Exception as e:
         logging.error(f"🚨 Критическая ошибка: {e}")
     finally:
+        await on_shutdown()
         await bot.session.close()
 
 if __name__ == "__main__":
@@ -0,0 +1,96 @@
+"""Два экземпляра бота с общей SQLite-базой (SHARED_STATE=1).
+
+main.py загружается дважды под разными именами: у каждого экземпляра свои словари в памяти,
+общая только база во временном каталоге.
+
+Запуск: python -m pytest test_shared_state.py
+"""
+import asyncio
+import importlib.util
+import json
+import os
+import sqlite3
+import tempfile
+import time
+
+import pytest
+
+MAIN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+CONTEST_ID = '123456'
+
+
+def load_instance(name: str):
+    spec = importlib.util.spec_from_file_location(name, MAIN_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.storage.open()
+    module.storage.load()
+    return module
+
+
+@pytest.fixture
+def instances(monkeypatch):
+    monkeypatch.setenv('BOT_TOKEN', '1:test')
+    monkeypatch.setenv('SHARED_STATE', '1')
+    monkeypatch.setenv('FSM_STORAGE', 'memory')
+    monkeypatch.setenv('DB_PATH', os.path.join(tempfile.mkdtemp(), 'shared.db'))
+    a, b = load_instance('bot_a'), load_instance('bot_b')
+    yield a, b
+    for module in (a, b):
+        module.storage.conn.close()
+
+
+def stored_contest(module) -> dict:
+    conn = sqlite3.connect(module.DB_PATH)
+    try:
+        row = conn.execute("SELECT data FROM contests WHERE contest_id = ?", (CONTEST_ID,)).fetchone()
+    finally:
+        conn.close()
+    return json.loads(row[0])
+
+
+def test_stale_copy_does_not_reactivate_finished_contest(instances):
+    a, b = instances
+
+    async def scenario():
+        a.register_contest(CONTEST_ID, {
+            'conditions': 'Розыгрыш', 'winner_count': 1, 'channel_id': -100, 'channel_username': 'old',
+            'message_id': 1, 'creator_id': 1, 'is_active': True, 'is_fast': True,
+            'ends_at': time.time() + 3600, 'draw_seed': '00' * 32,
+        })
+        await a.storage.flush()
+        await b.storage.sync()
+        assert b.contests[CONTEST_ID]['is_active']
+
+        # A подводит итоги, B в это время обновляет username канала в своей копии
+        a.contests[CONTEST_ID]['winners'] = [42]
+        a.finish_contest(CONTEST_ID)
+        await a.storage.flush()
+        b.contests[CONTEST_ID]['channel_username'] = 'renamed'
+        b.storage.save_contest(CONTEST_ID)
+        await b.storage.flush()
+
+        row = stored_contest(a)
+        assert row['is_active'] is False
+        assert row['winners'] == [42]
+        assert row['channel_username'] == 'renamed'
+        # B принял завершение из базы при записи, A - при синхронизации
+        assert b.contests[CONTEST_ID]['is_active'] is False
+        assert b.contests[CONTEST_ID]['winners'] == [42]
+        await a.storage.sync()
+        assert a.contests[CONTEST_ID]['is_active'] is False
+        assert a.contests[CONTEST_ID]['channel_username'] == 'renamed'
+        assert CONTEST_ID not in a.deadlines._deadlines and CONTEST_ID not in b.deadlines._deadlines
+
+    asyncio.run(scenario())
+
+
+def test_join_is_registered_once_across_instances(instances):
+    a, b = instances
+
+    async def scenario():
+        first = await a.storage.join(CONTEST_ID, 7, 'u7', 'n7')
+        second = await b.storage.join(CONTEST_ID, 7, 'u7', 'n7')
+        return first, second
+
+    assert asyncio.run(scenario()) == (True, False)